@@ -0,0 +1,328 @@
+#! /usr/bin/env python
+"""
+Benchmarks for TableFu.
+
+Generates synthetic tables from a fixed seed, times the main
+TableFu operations and the Formatter filters at each size and
+width, and saves the results as JSON.
+
+    python benchmark.py
+    python benchmark.py --sizes 1e3,1e5,1e7 --widths 8,32 --output after.json
+    python benchmark.py --compare before.json --output after.json
+"""
+from __future__ import with_statement
+
+import csv
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from table_fu import TableFu
+from table_fu.formatting import Formatter
+
+STYLES = ['Modernism', 'Minimalism', 'Satire', 'Science fiction', 'Romance',
+          'Mystery', 'Memoir', 'Poetry', 'Horror', 'Western']
+STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
+          'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia',
+          'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas',
+          'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts',
+          'Michigan', 'Minnesota', 'Mississippi', 'Missouri', 'Montana',
+          'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey', 'New Mexico',
+          'New York', 'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma',
+          'Oregon', 'Pennsylvania', 'Rhode Island', 'South Carolina',
+          'South Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virginia',
+          'Washington', 'West Virginia', 'Wisconsin', 'Wyoming']
+BASE_COLUMNS = ['Id', 'Name', 'Style', 'State', 'Pages', 'Price', 'Share']
+
+# processes for the from_file.workers benchmark
+WORKERS = 4
+
+# operations too slow or too big to run past a certain number of rows
+LIMITS = {
+    'transpose': 10 ** 5,
+    'html': 10 ** 6,
+    'write_html': 10 ** 6,
+    'json': 10 ** 6,
+}
+
+
+class Sink(object):
+    "A file that throws away what's written to it"
+    def write(self, data):
+        pass
+
+
+def columns(width):
+    "Column names for a table of a given width"
+    names = BASE_COLUMNS[:width]
+    for i in xrange(len(names), width):
+        names.append('Extra %s' % i)
+    return names
+
+
+def generate_rows(size, width, seed=0):
+    """
+    Yields `size` rows of `width` string cells, the same
+    every time for a given seed
+    """
+    rand = random.Random(seed)
+    extra = max(width - len(BASE_COLUMNS), 0)
+    for i in xrange(size):
+        row = [
+            str(i),
+            'Author %s' % rand.randint(0, size),
+            rand.choice(STYLES),
+            rand.choice(STATES),
+            str(rand.randint(50, 1500)),
+            '%.2f' % rand.uniform(1, 100),
+            '%.4f' % rand.random(),
+        ][:width]
+        row.extend('x%s' % rand.randint(0, 1000) for j in xrange(extra))
+        yield row
+
+
+def write_csv(path, size, width, seed=0):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns(width))
+        writer.writerows(generate_rows(size, width, seed))
+
+
+def timed(func, setup=None, repeat=3):
+    """
+    Runs func(setup()) `repeat` times, timing only func,
+    and returns the best and mean times in seconds
+    """
+    times = []
+    for i in xrange(repeat):
+        arg = setup() if setup else None
+        start = default_timer()
+        func(arg)
+        times.append(default_timer() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def table_benchmarks(path, width):
+    """
+    Returns (name, func, setup) for each TableFu benchmark on
+    the table at path. Setup builds a fresh table so that
+    in-place operations don't affect each other.
+    """
+    base = TableFu.from_file(path)
+    header = list(base.default_columns)
+
+    def fresh():
+        rows = [list(row) for row in base.table]
+        rows.insert(0, list(header))
+        return TableFu(rows)
+
+    states = TableFu([['State', 'Code']] +
+        [[state, state[:2].upper()] for state in STATES])
+
+    def formatted():
+        table = fresh()
+        table.formatting = {
+            'Name': {'filter': 'link', 'args': ['Style']},
+            'Price': {'filter': 'dollars'},
+        }
+        return table
+
+    cache_dir = path + '.cache'
+
+    def cold_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def warm_cache():
+        TableFu.from_file(path, cache_dir=cache_dir)
+
+    return [
+        ('from_file', lambda t: TableFu.from_file(path), None),
+        ('from_file.mmap', lambda t: TableFu.from_file(path, mmap=True), None),
+        ('from_file.columnar', lambda t: TableFu.from_file(path, columnar=True), None),
+        ('from_file.workers', lambda t: TableFu.from_file(path, workers=WORKERS,
+            columnar=True), None),
+        ('from_file.lazy', lambda t: TableFu.from_file(path, lazy=True).count(), None),
+        ('from_file.cache_cold', lambda t: TableFu.from_file(path, cache_dir=cache_dir),
+            cold_cache),
+        ('from_file.cache_warm', lambda t: TableFu.from_file(path, cache_dir=cache_dir),
+            warm_cache),
+        ('from_file.cache_warm_columnar', lambda t: TableFu.from_file(path,
+            cache_dir=cache_dir, columnar=True), warm_cache),
+        ('sort', lambda t: t.sort('Pages'), fresh),
+        ('sort_multi', lambda t: t.sort(['Style', ('Pages', True)]), fresh),
+        ('top', lambda t: t.top(50, by='Pages'), lambda: base),
+        ('filter', lambda t: t.filter(Style='Satire'), lambda: base),
+        ('filter_multi', lambda t: t.filter(Style='Satire', State='Texas'), lambda: base),
+        ('query', lambda t: t.query().where(Style='Satire').select('Name', 'Pages')
+            .order_by('Pages').limit(50).execute(), lambda: base),
+        ('facet_by', lambda t: t.facet_by('Style'), lambda: base),
+        ('join', lambda t: t.join(states, on='State'), lambda: base),
+        ('transpose', lambda t: t.transpose(), lambda: base),
+        ('transform', lambda t: t.transform('Pages', int), fresh),
+        ('transform_batch', lambda t: t.transform('Pages',
+            lambda pages: [int(p) for p in pages], batch=True), fresh),
+        ('derive', lambda t: t.derive('Cost', lambda price, pages: float(price) * int(pages),
+            'Price', 'Pages'), fresh),
+        ('total', lambda t: t.total('Pages'), lambda: base),
+        ('values', lambda t: t.values('State', unique=True), lambda: base),
+        ('html', lambda t: t.html(), formatted),
+        ('write_html', lambda t: t.write_html(Sink()), formatted),
+        ('csv', lambda t: t.csv(), lambda: base),
+        ('write_csv', lambda t: t.write_csv(Sink()), lambda: base),
+        ('write_csv_formatted', lambda t: t.write_csv(Sink(), formatted=True), formatted),
+        ('json', lambda t: t.json(), lambda: base),
+    ]
+
+
+def formatter_benchmarks(size, seed=0):
+    "Returns (name, func) for each Formatter filter over `size` values"
+    rand = random.Random(seed)
+    format = Formatter()
+    cached = Formatter(cache=True)
+    numbers = [rand.randint(0, 10 ** 9) for i in xrange(size)]
+    floats = [rand.uniform(-1, 1) for i in xrange(size)]
+    states = [rand.choice(STATES) for i in xrange(size)]
+    words = ['some words %s' % i for i in xrange(size)]
+
+    def run(name, values, *args, **kwargs):
+        formatter = kwargs.get('formatter', format)
+        return lambda arg: [formatter(v, name, *args) for v in values]
+
+    return [
+        ('format.intcomma', run('intcomma', numbers)),
+        ('format.dollars', run('dollars', numbers)),
+        ('format.percentage', run('percentage', floats)),
+        ('format.percent_change', run('percent_change', floats)),
+        ('format.ratio', run('ratio', floats)),
+        ('format.many.intcomma', lambda arg: format.many(numbers, 'intcomma')),
+        ('format.many.dollars', lambda arg: format.many(numbers, 'dollars')),
+        ('format.ap_state', run('ap_state', states)),
+        ('format.state_postal', run('state_postal', states)),
+        ('format.stateface', run('stateface', states)),
+        ('format.ap_state_cached', run('ap_state', states, formatter=cached)),
+        ('format.stateface_cached', run('stateface', states, formatter=cached)),
+        ('format.title', run('title', words)),
+        ('format.capfirst', run('capfirst', words)),
+        ('format.link', run('link', words, 'http://example.com')),
+    ]
+
+
+def git_commit():
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        return out.strip() or None
+    except OSError:
+        return None
+
+
+def run(sizes, widths, repeat=3, seed=0, only=None, echo=True):
+    """
+    Runs every benchmark at every size and width, returning
+    a dict ready to be saved as JSON
+    """
+    results = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            for width in widths:
+                path = os.path.join(workdir, 'bench-%s-%s.csv' % (size, width))
+                write_csv(path, size, width, seed)
+                for name, func, setup in table_benchmarks(path, width):
+                    if only and name not in only:
+                        continue
+                    if size > LIMITS.get(name, size):
+                        continue
+                    result = timed(func, setup, repeat)
+                    result.update(name=name, rows=size, width=width)
+                    results.append(result)
+                    if echo:
+                        report(result)
+                os.remove(path)
+
+            for name, func in formatter_benchmarks(size, seed):
+                if only and name not in only:
+                    continue
+                result = timed(func, None, repeat)
+                result.update(name=name, rows=size, width=1)
+                results.append(result)
+                if echo:
+                    report(result)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seed': seed,
+        'results': results,
+    }
+
+
+def report(result, previous=None):
+    line = '%-22s rows=%-9s width=%-4s best=%.4fs mean=%.4fs' % (
+        result['name'], result['rows'], result['width'],
+        result['best'], result['mean'])
+    if previous:
+        line += '  (%.2fx)' % (previous['best'] / max(result['best'], 1e-9))
+    print line
+    sys.stdout.flush()
+
+
+def compare(before, after):
+    "Print the speedup of each result in `after` over `before`"
+    key = lambda r: (r['name'], r['rows'], r['width'])
+    old = dict((key(r), r) for r in before['results'])
+    print '\nCompared with %s:' % (before.get('commit') or 'previous run')
+    for result in after['results']:
+        if key(result) in old:
+            report(result, old[key(result)])
+
+
+def parse_sizes(value):
+    return [int(float(v)) for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='1e3,1e4,1e5',
+        help='comma-separated row counts, like 1e3,1e5,1e7 [%default]')
+    parser.add_option('--widths', default='7,32',
+        help='comma-separated column counts [%default]')
+    parser.add_option('--repeat', type='int', default=3,
+        help='times to run each benchmark [%default]')
+    parser.add_option('--seed', type='int', default=0,
+        help='seed for generated data [%default]')
+    parser.add_option('--only', default='',
+        help='comma-separated benchmark names to run')
+    parser.add_option('--output', default='benchmark.json',
+        help='file to save results to [%default]')
+    parser.add_option('--compare', default=None,
+        help='a saved results file to compare against')
+    options, args = parser.parse_args(argv)
+
+    only = set(n for n in options.only.split(',') if n)
+    results = run(parse_sizes(options.sizes), parse_sizes(options.widths),
+        options.repeat, options.seed, only)
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print '\nSaved results to %s' % options.output
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,8 +12,12 @@ __version__ = "0.4.2"
 __author__ = "Chris Amico (eyeseast@gmail.com)"
 
 import csv
+import heapq
 import urllib2
-from copy import copy
+from array import array
+from itertools import islice, izip
+from operator import itemgetter
+from decimal import InvalidOperation
 
 try:
     from cStringIO import StringIO
@@ -30,7 +34,24 @@ except ImportError:
     except ImportError:
         has_json = False
 
+try:
+    import numpy
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+from table_fu.aggregates import GroupBy, RunningTotals
+from table_fu.cache import TableCache
+from table_fu.columnar import ColumnarTable, paused_gc
+from table_fu.converters import (convert_column, converter_name,
+    get_converter, infer_converter, is_blank)
 from table_fu.formatting import format
+from table_fu.indexes import HashIndex, SortedIndex
+from table_fu.plan import Query
+from table_fu.query import compile_query
+from table_fu.remote import load_all
+from table_fu.sorting import Reversed, sort_keys, sort_spec
+from table_fu.sources import MappedTable, RowView, cpu_count, parse_parallel
 
 class TableFu(object):
     """
@@ -66,58 +87,541 @@ class TableFu(object):
         The 'table' argument should be a two-dimensional array,
         either a list or tuple, or an open file that can be
         parsed by Python's csv module (using csv.reader)
+
+        Passing lazy=True with a file leaves rows in the file
+        until they're needed. Iterating rows, filtering, exporting
+        and the like stream from the file in a single pass, while
+        anything that needs the whole table (sorting, indexing,
+        len) reads in whatever rows are left.
+
+        Passing columnar=True stores the table column by column,
+        with integer and float columns packed into arrays. Values
+        in those columns come back as numbers instead of strings.
+
+        Column types can be declared with types={'column': type},
+        where type is 'int', 'float', 'decimal', 'date' or any
+        callable, or inferred for every column with infer_types=True.
+        Typed columns are parsed once and used for totals, sorting,
+        filtering and formatting.
         """
+        self._reader = None
+        self._streamed = False
+        self.version = 0 # counts changes to rows, for facets
+        self._schema = None
+        self._typed = {}
+        self._inferred = {}
+        self._renderers = None
+        self.indexes = {}
+        self.totals = {}
         if hasattr(table, 'next'): # for file-like objects
             csv_options = {}
             if 'dialect' in options:
                 csv_options['dialect'] = options.pop('dialect')
             reader = csv.reader(table, **csv_options)
-            self.table = [row for row in reader]
+            if options.pop('lazy', False):
+                # keep the reader open and pull rows only when asked
+                self.default_columns = reader.next()
+                self._table = []
+                self._reader = reader
+            else:
+                with paused_gc():
+                    self.table = [row for row in reader]
+                self.default_columns = self.table.pop(0)
+        elif isinstance(table, (MappedTable, RowView)) or getattr(table, 'header', None) is not None:
+            self.table = table
+            self.default_columns = table.header
         else:
             self.table = table
-        self.default_columns = self.table.pop(0)
+            self.default_columns = self.table.pop(0)
+        if options.get('columnar', False) and not isinstance(self._table, ColumnarTable):
+            self.table = ColumnarTable(self._iter_table(), len(self.default_columns))
         self._columns = options.get('columns', [])
         self.deleted_rows = []
         self.faceted_on = None
-        self.totals = {}
+        self.options = options
         self.formatting = options.get('formatting', {})
         self.style = options.get('style', {})
-        self.options = options
+        self._types = {}
+        for column_name, kind in options.get('types', {}).items():
+            self._types[column_name] = get_converter(kind)
         if options.has_key('sorted_by'):
-            col = options['sorted_by'].keys()[0]
-            self.sort(column_name=col, 
-            reverse=options['sorted_by'][col].get('reverse', False))
+            self.sort(options['sorted_by'])
+
+    def _get_table(self):
+        if self._streamed:
+            raise ValueError("This lazy table's rows have already been read")
+        if self._reader is not None:
+            self._table.extend(self._reader)
+            self._reader = None
+        return self._table
+
+    def _set_table(self, table):
+        self._reader = None
+        self._streamed = False
+        self.version += 1
+        self._table = table
+        self._invalidate()
+        self._reindex()
+        self._retrack()
+
+    table = property(_get_table, _set_table)
+
+    def _iter_table(self):
+        """
+        Iterate over raw rows, streaming them from the
+        source file if this table is lazy. A lazy table's
+        rows can only be streamed once.
+        """
+        if self._reader is not None:
+            reader, self._reader = self._reader, None
+            self._streamed = True
+            return reader
+        return iter(self.table)
+
+    @property
+    def lazy(self):
+        "True if rows are still waiting to be read from the source"
+        return self._reader is not None
+
+    def _get_default_columns(self):
+        return self._default_columns
+
+    def _set_default_columns(self, columns):
+        self._default_columns = columns
+        self._schema = None
+
+    default_columns = property(_get_default_columns, _set_default_columns)
+
+    @property
+    def schema(self):
+        """
+        Column lookups for this table, rebuilt only when
+        columns or default_columns are reassigned
+        """
+        if self._schema is None:
+            self._schema = Schema(self.default_columns, self._columns)
+        return self._schema
+
+    def _get_formatting(self):
+        return self._formatting
+
+    def _set_formatting(self, formatting):
+        if not isinstance(formatting, Formatting):
+            formatting = Formatting(formatting)
+        if 'formatting' in self.options:
+            # tables made from this one's options share its formatting
+            self.options['formatting'] = formatting
+        self._formatting = formatting
+        self._renderers = None
+
+    formatting = property(_get_formatting, _set_formatting)
+
+    def _render_plan(self):
+        """
+        A function for each column that takes a row's cells and
+        returns that column's cell as a string, with any formatting.
+        Compiled once, then again only when formatting, columns,
+        the table or the registered filters change.
+        """
+        key = (self.schema, self._formatting.version, format.version)
+        if self._renderers is None or self._renderers[0] != key:
+            plan = {}
+            for name in self.default_columns:
+                plan[name] = self._compile_renderer(name)
+            self._renderers = key, plan
+        return self._renderers[1]
+
+    def _compile_renderer(self, column_name):
+        index = self.schema.indexes[column_name]
+        spec = self._formatting.get(column_name) or {}
+        func = spec.get('filter', None)
+        if not func:
+            def render(cells):
+                value = cells[index]
+                if isinstance(value, basestring):
+                    return value
+                return str(value)
+            return render
+
+        if not callable(func):
+            func = format._filters[func]
+        args = [self.schema.indexes[arg] for arg in spec.get('args', [])]
+        kwargs = spec.get('options', {})
+        convert = self.column_type(column_name)
+
+        def render(cells):
+            value = cells[index]
+            if convert is not None and not is_blank(value):
+                try:
+                    value = convert(value)
+                except (ValueError, TypeError, InvalidOperation):
+                    pass
+            if args:
+                return func(value, *[cells[i] for i in args], **kwargs)
+            return func(value, **kwargs)
+        return render
+
+    def _index(self, column_name):
+        "Return the position of column_name, or raise ValueError"
+        try:
+            return self.schema.indexes[column_name]
+        except KeyError:
+            raise ValueError("%s isn't a column in this table" % column_name)
+
+    def _writable(self):
+        """
+        Return the table, copying rows out of a read-only
+        source (like a memory-mapped file) before changing it.
+        Everything that changes rows gets them from here.
+        """
+        self.version += 1
+        if getattr(self.table, 'readonly', False):
+            # same rows, so parsed columns and indexes still hold
+            self._table = [list(row) for row in self._table]
+        return self._table
+
+    def _invalidate(self):
+        "Forget parsed and inferred column types after the table changes"
+        self._typed = {}
+        self._inferred = {}
+        self._renderers = None
+
+    def _reorder(self, order):
+        """
+        Put rows, and any parsed columns, in a new order,
+        given as a list of current row positions
+        """
+        table = self._writable()
+        packed = []
+        if isinstance(table, ColumnarTable):
+            packed = [i for i, values in self._typed.items() if values is table.column(i)]
+            table.reorder(order)
+        else:
+            table[:] = [table[i] for i in order]
+        for index, values in self._typed.items():
+            if index in packed:
+                # still the table's own column, now reordered
+                self._typed[index] = table.column(index)
+            elif isinstance(values, array):
+                self._typed[index] = array(values.typecode, [values[i] for i in order])
+            else:
+                self._typed[index] = [values[i] for i in order]
+        self._reindex()
+
+    def create_index(self, column_name, kind='hash'):
+        """
+        Index a column, keeping the index up to date as the
+        table changes. A column has at most one index.
+
+        A 'hash' index lets equality filters, unique values
+        and facets look rows up instead of scanning.
+
+        A 'sorted' index keeps the column's (typed) values in
+        order, for range filters, min, max and ordered_by.
+        Untyped columns that hold only numbers are kept in
+        order as floats. If
+        options['sorted_by'] says the table is already sorted
+        on the column, that order is checked and reused.
+        """
+        if kind == 'hash':
+            index = HashIndex(column_name)
+        elif kind == 'sorted':
+            index = SortedIndex(column_name)
+        else:
+            raise ValueError("%s isn't a kind of index" % kind)
+        self._build_index(index)
+        self.indexes[column_name] = index
+        return index
+
+    def drop_index(self, column_name):
+        self.indexes.pop(column_name, None)
+
+    def _column_values(self, column_name):
+        "Every value in a column, reading in a lazy table first"
+        index = self._index(column_name)
+        self.table
+        return self._column(index)
+
+    def _build_index(self, index):
+        name = index.column_name
+        if index.kind == 'sorted':
+            index.typed = self.column_type(name) is not None
+            index.numeric = False
+            # only the first sort key puts its column in order
+            keys = sort_keys(self.options.get('sorted_by'))
+            presorted = None
+            if keys and keys[0][0] == name:
+                presorted = keys[0][1]
+            if index.typed:
+                values = self.typed_values(name)
+            else:
+                # untyped columns of numbers are indexed as numbers
+                values = list(self._column_values(name))
+                try:
+                    values = convert_column(values, float)
+                    index.numeric = True
+                except (ValueError, TypeError):
+                    pass
+            index.build(values, presorted)
+        else:
+            index.build(self._column_values(name))
+
+    def _reindex(self, column_name=None):
+        "Rebuild indexes, or just the index on column_name"
+        for name, index in self.indexes.items():
+            if column_name is None or name == column_name:
+                self._build_index(index)
+
+    def track(self, column_name, aggregates=RunningTotals.KINDS):
+        """
+        Keep running aggregates of a column (any of sum, count,
+        min, max and mean) in self.totals[column_name], updated
+        as rows are added, updated, transformed or deleted:
+
+            >>> table.track('Number of Pages', ['sum', 'max'])
+            >>> table.add_rows(['Jack Kerouac', 'On the Road', '320', 'Beat'])
+            >>> table.totals['Number of Pages']['sum']
+            2585.0
+
+        Typed columns track their typed values. Other columns
+        are read as floats. Blank cells are left out.
+        """
+        self._index(column_name)
+        totals = RunningTotals(column_name, aggregates)
+        # count first, so a column that can't be totaled isn't tracked
+        self._count(totals)
+        self.totals[column_name] = totals
+        return totals
+
+    def untrack(self, column_name):
+        self.totals.pop(column_name, None)
+
+    def _retrack(self, column_name=None):
+        "Recount tracked totals, or just those for column_name"
+        for name, totals in self.totals.items():
+            if column_name is None or name == column_name:
+                self._count(totals)
+
+    def _count(self, totals):
+        "Count a column's totals from scratch"
+        name = totals.column_name
+        totals.clear()
+        func = self.column_type(name)
+        totals.func = func or float
+        if func is not None:
+            totals.extend(self.typed_values(name))
+        else:
+            totals.extend(totals.convert(v) for v in self._column_values(name))
+
+    def column_type(self, column_name):
+        """
+        Return the converter for a column, either declared in
+        options['types'] or inferred, or None for untyped columns
+        """
+        index = self._index(column_name)
+        if column_name in self._types:
+            return self._types[column_name]
+        if index not in self._inferred:
+            func = None
+            packed = self._packed_type(index)
+            if packed:
+                func = packed
+            elif self.options.get('infer_types', False):
+                self.table # read in the rest of a lazy table first
+                func = infer_converter(self._column(index))
+            self._inferred[index] = func
+        return self._inferred[index]
+
+    def _packed_type(self, index):
+        "The Python type stored in a columnar table's array, if any"
+        if not isinstance(self._table, ColumnarTable):
+            return None
+        typecode = self._table.typecodes[index]
+        return {'l': int, 'd': float}.get(typecode)
+
+    def typed_values(self, column_name):
+        """
+        Return the values in a column converted to its type,
+        parsing them only once. Blank cells become None.
+        Untyped columns are returned as they are.
+        """
+        func = self.column_type(column_name)
+        index = self._index(column_name)
+        self.table # read in the rest of a lazy table first
+        if func is None:
+            return list(self._column(index))
+        if index not in self._typed:
+            values = self._column(index)
+            if func is self._packed_type(index):
+                self._typed[index] = values
+                return values
+            try:
+                self._typed[index] = convert_column(values, func)
+            except (ValueError, TypeError, InvalidOperation):
+                raise ValueError('Column %s contains values that can\'t be converted' % column_name)
+        return self._typed[index]
+
+    def _column(self, index):
+        """
+        Iterate over the raw values in one column, using
+        the packed column itself for columnar tables
+        """
+        if isinstance(self._table, ColumnarTable):
+            return self._table.column(index)
+        return (row[index] for row in self._iter_table())
 
     def __getitem__(self, row_num):
         """
-        Return one row in the table
+        Return one row in the table, or a list of rows
+        for a slice
         """
+        if isinstance(row_num, slice):
+            positions = xrange(*row_num.indices(len(self)))
+            return [Row(cells, i, self) for i, cells in zip(positions, self.table[row_num])]
         return Row(self.table[row_num], row_num, self)
     
     def __iter__(self):
         return iter(self.rows)
 
     def __len__(self):
-        return len(list(self.table))
+        if self._streamed:
+            # a TypeError, so list() can still ask for a length
+            raise TypeError("A lazy table that's been read has no length")
+        return len(self.table)
 
     def add_rows(self, *rows):
+        # convert tracked values first, so a bad one raises before the table changes
+        tracked = []
+        for column_name, totals in self.totals.items():
+            tracked.append((totals, self._convert_tracked(totals, rows)))
+        table = self._writable()
+        start = len(table)
         for row in rows:
-            self.table.append(row)
-    
+            table.append(row)
+        self._invalidate()
+        for column_name, index in self.indexes.items():
+            i = self._index(column_name)
+            if index.kind == 'sorted':
+                func = self.column_type(column_name)
+                if index.typed != (func is not None):
+                    self._build_index(index)
+                    continue
+                if index.numeric:
+                    func = float
+                try:
+                    for position in xrange(start, len(table)):
+                        value = table[position][i]
+                        if func is not None:
+                            value = convert_column([value], func)[0]
+                        index.add(value, position)
+                except (ValueError, TypeError):
+                    # a new value that isn't a number, so index the column as text
+                    self._build_index(index)
+            else:
+                for position in xrange(start, len(table)):
+                    index.add(table[position][i], position)
+        for totals, values in tracked:
+            if (self.column_type(totals.column_name) or float) is not totals.func:
+                # the new rows changed the column's type
+                self._count(totals)
+            else:
+                totals.extend(values)
+
+    def _convert_tracked(self, totals, rows):
+        """
+        A tracked column's values in new rows. Values that don't
+        fit an inferred type are converted with the type the
+        column will have once they're added.
+        """
+        i = self._index(totals.column_name)
+        try:
+            return [totals.convert(row[i]) for row in rows]
+        except ValueError:
+            if totals.column_name in self._types:
+                raise
+        func = None
+        if self.options.get('infer_types', False):
+            cells = list(self._column(i)) + [row[i] for row in rows]
+            func = infer_converter(cells)
+        retyped = RunningTotals(totals.column_name, totals.aggregates, func)
+        return [retyped.convert(row[i]) for row in rows]
+
+    def update_row(self, row_num, values):
+        """
+        Set cells in one row of this table, given a dict of
+        column names and values. Tracked totals and parsed
+        columns are updated in place, and indexes on the
+        changed columns are rebuilt.
+
+        Rows themselves are copy-on-write, so setting a cell
+        on a Row changes only that row.
+        """
+        table = self._writable()
+        cells = table[row_num] # a copy, for columnar tables
+        for column_name, value in values.items():
+            index = self._index(column_name)
+            totals = self.totals.get(column_name)
+            if totals is not None:
+                totals.remove(totals.convert(cells[index]))
+                totals.add(totals.convert(value))
+
+            if isinstance(table, ColumnarTable):
+                column = table.column(index)
+                table.set(row_num, index, value)
+                if table.column(index) is not column:
+                    # the value didn't fit the packed column
+                    self._typed.pop(index, None)
+                    self._inferred.pop(index, None)
+            else:
+                cells[index] = value
+
+            typed = self._typed.get(index)
+            if isinstance(table, ColumnarTable) and typed is table.column(index):
+                pass # the packed column, already set
+            elif isinstance(typed, array):
+                # a copy of a packed column
+                del self._typed[index]
+            elif typed is not None:
+                func = self.column_type(column_name)
+                try:
+                    typed[row_num] = convert_column([value], func)[0]
+                except (ValueError, TypeError, InvalidOperation):
+                    del self._typed[index]
+                    self._inferred.pop(index, None)
+
+            if column_name in self.indexes:
+                self._reindex(column_name)
+
     def count(self):
-        return len(list(self))
+        if self.lazy:
+            return sum(1 for cells in self._iter_table())
+        return len(self.table)
     
     @property
     def rows(self):
-        return (Row(row, i, self) for i, row in enumerate(self.table))
+        return (Row(row, i, self) for i, row in enumerate(self._iter_table()))
+
+    def iter_rows(self, flyweight=False):
+        """
+        Iterate over rows. With flyweight=True, the same Row
+        is updated and yielded for every row, which saves
+        creating an object per row. Don't hold on to it.
+        """
+        if not flyweight:
+            return self.rows
+        return self._flyweight_rows()
+
+    def _flyweight_rows(self):
+        row = Row([], 0, self)
+        for i, cells in enumerate(self._iter_table()):
+            row.cells = cells
+            row.row_num = i
+            row._shared = True
+            yield row
 
     @property
     def headers(self):
-        if self._columns:
-            col_set = self._columns
-        else:
-            col_set = self.default_columns
-        return [Header(col, i, self) for i, col in enumerate(col_set)]
+        return [Header(col, i, self) for i, col in enumerate(self.schema.columns)]
 
     def _get_columns(self):
         if self._columns:
@@ -126,106 +630,581 @@ class TableFu(object):
 
     def _set_columns(self, columns):
         self._columns = self.options['columns'] = list(columns)
+        self._schema = None
 
     columns = property(_get_columns, _set_columns)
 
     def delete_row(self, row_num):
-        self.deleted_rows.append(self.table.rows.pop(row_num))
+        row = self._writable().pop(row_num)
+        self.deleted_rows.append(row)
+        for column_name, totals in self.totals.items():
+            totals.remove(totals.convert(row[self._index(column_name)]))
+        self._invalidate()
+        self._reindex()
     
     def sort(self, column_name=None, reverse=False):
         """
         Sort rows in this table, preserving a record of how that
         sorting is done in TableFu.options['sorted_by']
+
+        Typed columns sort by their converted values, so 120
+        comes before 1000. Other columns sort as strings.
+
+        To sort on more than one column, pass a list of column
+        names or (column, reverse) pairs, where reverse overrides
+        the reverse argument for that column:
+
+            table.sort(['Style', ('Number of Pages', True)])
+
+        Each column's sort keys are computed once, and only row
+        positions are sorted before the rows are put in order.
         """
-        if not column_name and self.options.has_key('sorted_by'):
-            column_name = self.options['sorted_by'].keys()[0]
-        if column_name not in self.default_columns:
-            raise ValueError("%s isn't a column in this table" % column_name)
-        index = self.default_columns.index(column_name)
-        self.table.sort(key = lambda row: row[index], reverse=reverse)
-        self.options['sorted_by'] = {column_name: {'reverse': reverse}}
+        if not column_name:
+            # sort on the same columns again, in the direction asked for
+            column_name = [name for name, rev in sort_keys(self.options.get('sorted_by'))]
+        keys = self._sort_columns(column_name, reverse)
+        order = range(len(keys[0][0]))
+        # stable sorts on later keys first leave earlier keys in charge,
+        # and neighboring keys with the same direction sort together
+        runs = []
+        for values, rev in keys:
+            if runs and runs[-1][1] == rev:
+                runs[-1][0].append(values)
+            else:
+                runs.append(([values], rev))
+        for columns, rev in reversed(runs):
+            if len(columns) == 1:
+                decorated = columns[0]
+            else:
+                decorated = zip(*columns)
+            order.sort(key=decorated.__getitem__, reverse=rev)
+        self._reorder(order)
+        self.options['sorted_by'] = sort_spec(sort_keys(column_name, reverse))
 
-    def transform(self, column_name, func):
-        if column_name not in self.default_columns:
-            raise ValueError("%s isn't a column in this table" % column_name)
+    def _sort_columns(self, spec, reverse=False):
+        "(typed values, reverse) for each key in a sort spec"
+        keys = sort_keys(spec, reverse)
+        if not keys:
+            raise ValueError("No column to sort by")
+        for name, rev in keys:
+            self._index(name)
+        return [(self.typed_values(name), rev) for name, rev in keys]
+
+    def top(self, n, by=None, reverse=True):
+        """
+        The first n rows this table would have if it were sorted
+        with sort(by, reverse), as a new TableFu, without sorting
+        the whole table. By default that's the n largest values.
+
+        Rows are picked with a heap, so this takes time in
+        proportion to the table's length and memory in
+        proportion to n.
+        """
+        if not by:
+            by = self.options.get('sorted_by')
+        keys = self._sort_columns(by, reverse)
+        columns = [values for values, rev in keys]
+        flipped = [rev != reverse for values, rev in keys]
+        if len(columns) == 1 and not flipped[0]:
+            key = columns[0].__getitem__
+        else:
+            pairs = zip(columns, flipped)
+            key = lambda i: tuple([
+                Reversed(values[i]) if flip else values[i]
+                for values, flip in pairs
+            ])
+
+        select = reverse and heapq.nlargest or heapq.nsmallest
+        table = self.table
+        rows = [list(table[i]) for i in select(n, xrange(len(table)), key=key)]
+        rows.insert(0, self.default_columns)
+        options = self.options.copy()
+        options['sorted_by'] = sort_spec(sort_keys(by, reverse))
+        return TableFu(rows, **options)
+
+    def nlargest(self, n, column_name):
+        "The n rows with the largest values in a column"
+        return self.top(n, column_name, reverse=True)
+
+    def nsmallest(self, n, column_name):
+        "The n rows with the smallest values in a column"
+        return self.top(n, column_name, reverse=False)
+
+    def transform(self, column_name, func, batch=False, numpy=False):
+        """
+        Apply func to every value in a column, in place.
+
+        With batch=True, func is called once with the whole
+        column and returns the new column. It gets the column's
+        typed values (raw cells for untyped columns) as a list,
+        or as a NumPy array with numpy=True.
+        """
+        index = self._index(column_name)
+
+        if not callable(func):
+            raise TypeError("%s isn't callable" % func)
+
+        if batch:
+            values = self._batch_call(func, [column_name], numpy)
+            self._invalidate()
+            self._set_column(index, values)
+        else:
+            self._invalidate()
+            table = self._writable()
+            if isinstance(table, ColumnarTable):
+                table.set_column(index, map(func, table.column(index)))
+            else:
+                for row in table:
+                    row[index] = func(row[index])
+        self._reindex(column_name)
+        self._retrack(column_name)
 
+    def derive(self, column_name, func, *columns, **kwargs):
+        """
+        Make a column from other columns' (typed) values:
+
+            table.derive('Price per page', lambda price, pages: price / pages,
+                'Price', 'Number of Pages')
+
+        func is called with a value from each column, row by row,
+        or with batch=True, once with each whole column, like
+        transform (numpy=True passes NumPy arrays). A column
+        that already exists is replaced.
+        """
         if not callable(func):
             raise TypeError("%s isn't callable" % func)
+        if not columns:
+            raise ValueError("derive needs at least one column")
+        if kwargs.get('batch', False):
+            values = self._batch_call(func, columns, kwargs.get('numpy', False))
+        else:
+            values = map(func, *[self.typed_values(c) for c in columns])
+
+        self._invalidate()
+        if column_name in self.default_columns:
+            self._set_column(self._index(column_name), values)
+            self._reindex(column_name)
+            self._retrack(column_name)
+            return
+
+        table = self._writable()
+        if isinstance(table, ColumnarTable):
+            table.add_column(values)
+        else:
+            for row, value in izip(table, values):
+                row.append(value)
+        self.default_columns = list(self.default_columns) + [column_name]
+        if self._columns:
+            self.columns = self._columns + [column_name]
+
+    def _batch_call(self, func, columns, arrays=False):
+        """
+        Call func with whole columns, as lists or NumPy arrays,
+        and return the column it makes as a list
+        """
+        if arrays and not has_numpy:
+            raise ValueError("Couldn't find NumPy")
+        args = [list(self.typed_values(c)) for c in columns]
+        if arrays:
+            args = [numpy.array(values) for values in args]
+        result = func(*args)
+        if hasattr(result, 'tolist'):
+            result = result.tolist()
+        else:
+            result = list(result)
+        if len(result) != len(self.table):
+            raise ValueError("%s returned %s values for %s rows" % (
+                func, len(result), len(self.table)))
+        return result
 
-        index = self.default_columns.index(column_name)
-        for row in self.table:
-            val = row[index]
-            val = func(val)
-            row[index] = val
+    def _set_column(self, index, values):
+        "Replace the raw values in one column"
+        table = self._writable()
+        if isinstance(table, ColumnarTable):
+            table.set_column(index, values)
+        else:
+            for row, value in izip(table, values):
+                row[index] = value
 
     def values(self, column_name, unique=False):
-        if column_name not in self.default_columns:
-            raise ValueError("%s isn't a column in this table" % column_name)
-        index = self.default_columns.index(column_name)
-        result = [row[index] for row in self.table]
+        index = self._index(column_name)
+        if unique and column_name in self.indexes:
+            return set(self.indexes[column_name].keys())
+        result = list(self._column(index))
         if unique:
             return set(result)
         return result
     
     def total(self, column_name):
-        if column_name not in self.default_columns:
-            raise ValueError("%s isn't a column in this table" % column_name)
-        
+        index = self._index(column_name)
+        totals = self.totals.get(column_name)
+        if totals is not None and 'sum' in totals.aggregates:
+            return float(totals.sum)
+        if self.column_type(column_name) is not None:
+            values = self.typed_values(column_name)
+            if isinstance(values, array):
+                return float(sum(values))
+            try:
+                return float(sum(v for v in values if v is not None))
+            except TypeError:
+                raise ValueError('Column %s contains non-numeric values' % column_name)
+        values = self._column(index)
         try:
-            values = (float(v) for v in self.values(column_name))
+            # blanks are left out, as they are for typed and tracked columns
+            return sum(float(v) for v in values if not is_blank(v))
         except ValueError:
             raise ValueError('Column %s contains non-numeric values' % column_name)
-        
-        return sum(values)
     
     def filter(self, func=None, **query):
         """
         Tables can be filtered in one of two ways:
-         - Simple keyword arguments return rows where values match *exactly*
+         - Keyword arguments return rows where values match
          - Pass in a function and return rows where that function evaluates to True
         
-        In either case, a new TableFu instance is returned
+        In either case, a new TableFu instance is returned.
+
+        Keywords match values *exactly*, or can use Django-style
+        operators: Style__in=[...], Author__startswith='S',
+        or {'Number of Pages__gt': 100}. The available operators
+        are exact, iexact, contains, icontains, startswith,
+        endswith, in, gt, gte, lt, lte, range and isnull.
+
+        Keyword values that aren't strings are compared with the
+        converted values of typed columns (or floats, for untyped
+        ones), so filter(Pages=120) matches '120'.
+
+        All keywords are checked together in a single pass.
+        An exact or in lookup on an indexed column only checks
+        the rows the index points to.
         """
         if callable(func):
-            result = filter(func, self)
-            result.insert(0, self.default_columns)
-            return TableFu(result, **self.options)
+            result = [list(row.cells) for row in self.rows if func(row)]
         else:
-            result = self
-            for column, value in query.items():
-                result = result.filter(lambda r: r[column] == value)
-            return result
+            predicate = compile_query(self, query)
+            positions = self._indexed_positions(predicate)
+            if positions is None:
+                result = [
+                    list(cells) for i, cells in enumerate(self._iter_table())
+                    if predicate(cells, i)
+                ]
+            else:
+                table = self.table
+                result = []
+                for i in positions:
+                    cells = table[i]
+                    if predicate(cells, i):
+                        result.append(list(cells))
+        result.insert(0, self.default_columns)
+        return TableFu(result, **self.options)
+
+    def _indexed_positions(self, predicate):
+        """
+        The fewest candidate rows any index can find for
+        a predicate, or None if no index applies
+        """
+        best = None
+        for condition in predicate.conditions:
+            index = self.indexes.get(condition.column_name)
+            if index is None:
+                continue
+            try:
+                if index.kind == 'sorted':
+                    # only if the index holds the same kind of values
+                    if index.numeric:
+                        if condition.convert is not float:
+                            continue
+                    elif condition.convert is not None:
+                        continue
+                    elif index.typed != (condition.typed is not None):
+                        continue
+                    positions = self._sorted_positions(index, condition)
+                elif condition.typed is not None or condition.convert is not None:
+                    continue
+                elif condition.op == 'exact':
+                    positions = index.lookup(condition.value)
+                elif condition.op == 'in':
+                    positions = index.lookup_many(condition.value)
+                else:
+                    continue
+            except TypeError: # unhashable values
+                continue
+            if positions is None:
+                continue
+            if best is None or len(positions) < len(best):
+                best = positions
+        return best
+
+    def _sorted_positions(self, index, condition):
+        "Row positions, in table order, for a range condition"
+        op, value = condition.op, condition.value
+        if op == 'exact':
+            positions = index.lookup(value)
+        elif op == 'range':
+            positions = index.range(value[0], value[1])
+        elif op == 'gt':
+            positions = index.range(low=value, include_low=False)
+        elif op == 'gte':
+            positions = index.range(low=value)
+        elif op == 'lt':
+            positions = index.range(high=value, include_high=False)
+        elif op == 'lte':
+            positions = index.range(high=value)
+        else:
+            return None
+        return sorted(positions)
+
+    def _comparable(self, column_name):
+        """
+        A column's values for min and max, without blanks: typed
+        values, or for untyped columns floats, as total() reads
+        them, or the cells themselves if any isn't a number
+        """
+        if self.column_type(column_name) is not None:
+            values = [v for v in self.typed_values(column_name) if not is_blank(v)]
+        else:
+            values = [v for v in self._column(self._index(column_name)) if not is_blank(v)]
+            try:
+                values = [float(v) for v in values]
+            except (ValueError, TypeError):
+                pass
+        if not values:
+            raise ValueError("%s has no values" % column_name)
+        return values
+
+    def min(self, column_name):
+        """
+        The smallest value in a column, ignoring blanks. Untyped
+        columns are read as numbers, or compared as text if they
+        hold any text. Uses a sorted index if there is one.
+        """
+        index = self.indexes.get(column_name)
+        if index is not None and index.kind == 'sorted':
+            return index.min()
+        return min(self._comparable(column_name))
+
+    def max(self, column_name):
+        """
+        The largest value in a column, ignoring blanks. Untyped
+        columns are read as numbers, or compared as text if they
+        hold any text. Uses a sorted index if there is one.
+        """
+        index = self.indexes.get(column_name)
+        if index is not None and index.kind == 'sorted':
+            return index.max()
+        return max(self._comparable(column_name))
+
+    def ordered_by(self, column_name, reverse=False):
+        """
+        Iterate over rows in order of a column's (typed) values,
+        or numbers for untyped columns of numbers, without
+        sorting the table. Uses a sorted index if
+        there is one.
+        """
+        index = self.indexes.get(column_name)
+        if index is None or index.kind != 'sorted':
+            index = SortedIndex(column_name)
+            self._build_index(index)
+        table = self.table
+        for i in index.ordered(reverse):
+            yield Row(table[i], i, self)
 
     def facet_by(self, column):
         """
         Faceting creates new TableFu instances with rows matching
         each possible value.
+
+        Facets are views: each keeps the positions of its rows
+        and reads them from this table, sharing its formatting,
+        style and options. Changing a facet copies its rows.
+        Once this table's rows change, reading a facet raises
+        ValueError, and facets have to be made again.
         """
-        faceted_spreadsheets = {}
-        for row in self.rows:
-            if row[column]:
-                col = row[column].value
-                if faceted_spreadsheets.has_key(col):
-                    faceted_spreadsheets[col].append(row.cells)
-                else:
-                    faceted_spreadsheets[col] = []
-                    faceted_spreadsheets[col].append(row.cells)
+        index = self._index(column)
+        table = self.table
+        if column in self.indexes and self.indexes[column].kind == 'hash':
+            facets = self.indexes[column].items()
+        else:
+            positions = {}
+            for i, cells in enumerate(table):
+                value = cells[index]
+                try:
+                    positions[value].append(i)
+                except KeyError:
+                    positions[value] = array('l', [i])
+            facets = positions.items()
 
         # create a new TableFu instance for each facet
         tables = []
-        for k, v in faceted_spreadsheets.items():
-            v.insert(0, self.default_columns)
-            table = TableFu(v)
-            table.faceted_on = k
-            table.formatting = self.formatting
-            table.options = self.options
-            tables.append(table)
+        for k, v in facets:
+            facet = TableFu(RowView(table, v, self.default_columns, self))
+            facet.faceted_on = k
+            facet.formatting = self.formatting
+            facet.style = self.style
+            facet.options = self.options
+            # the same column types, declared or inferred
+            facet._types = self._types
+            facet._inferred = self._inferred.copy()
+            tables.append(facet)
 
         tables.sort(key=lambda t: t.faceted_on)
         return tables
+
+    def group_by(self, *columns):
+        """
+        Group rows on the values of one or more columns,
+        to be summarized with aggregate:
+
+            table.group_by('Style').aggregate(
+                pages=('Number of Pages', 'sum'),
+                books=count,
+            )
+
+        Each aggregate is a (column, name) pair, where name is
+        sum, count, mean, min or max, a (column, function) pair,
+        an Aggregate or a function of each group's rows.
+        See table_fu.aggregates.
+
+        Aggregating reads the table once and returns a new TableFu
+        with a row for each group, sorted by the group's values.
+        """
+        return GroupBy(self, columns)
     
+    def query(self):
+        """
+        Start a lazy query on this table:
+
+            table.query().where(Style='Modernism').select('Author').limit(10)
+
+        Steps are only recorded until the query is iterated or
+        exported, then run in a single pass. Running a query on a
+        lazy table reads its rows from the file. See table_fu.plan.
+        """
+        return Query(self)
+
+    def join(self, other, on, how='inner', suffix='_2'):
+        """
+        Join another table to this one on one or more columns
+        both tables share, returning a new TableFu:
+
+            results.join(counties, on='FIPS', how='left')
+
+        The new table has this table's columns followed by the
+        other table's, less the ones joined on. Other columns with
+        the same name as one of this table's get a suffix.
+        Formatting, style and types are carried over from both.
+
+        An inner join keeps rows with a match in both tables, and
+        a left join keeps every row in this table, with blanks
+        where there's no match. Blank keys never match. Keys are
+        compared as raw cells, and rows come out in this table's
+        order.
+
+        The smaller table is put in a hash table and the other
+        is read through once. A lazy table is always the one
+        read through, and hash indexes on the keys are reused.
+        """
+        if how not in ('inner', 'left'):
+            raise ValueError("%s isn't a kind of join" % how)
+        if isinstance(on, basestring):
+            on = [on]
+        left_key = itemgetter(*[self._index(c) for c in on])
+        right_key = itemgetter(*[other._index(c) for c in on])
+        if len(on) == 1:
+            blank = is_blank
+        else:
+            blank = lambda key: any(is_blank(v) for v in key)
+
+        extra = []
+        columns = list(self.default_columns)
+        formatting, style, types = {}, {}, {}
+        for i, name in enumerate(other.default_columns):
+            if name in on:
+                continue
+            new_name = name
+            if name in columns:
+                new_name = name + suffix
+            extra.append(i)
+            columns.append(new_name)
+            for mine, theirs in ((formatting, other.formatting), (style, other.style),
+                (types, other.options.get('types', {}))):
+                if name in theirs:
+                    mine[new_name] = theirs[name]
+        if len(extra) == 1:
+            other_cells = lambda cells, i=extra[0]: (cells[i],)
+        elif extra:
+            other_cells = itemgetter(*extra)
+        else:
+            other_cells = lambda cells: ()
+
+        if self.lazy:
+            build_here = False
+        elif other.lazy:
+            build_here = True
+        else:
+            build_here = len(self) < len(other)
+
+        rows = []
+        if not build_here:
+            positions = other._hash_on(on, right_key)
+            right = other.table
+            nothing = [''] * len(extra)
+            for cells in self._iter_table():
+                key = left_key(cells)
+                matches = not blank(key) and positions.get(key)
+                if matches:
+                    for j in matches:
+                        rows.append(list(cells) + list(other_cells(right[j])))
+                elif how == 'left':
+                    rows.append(list(cells) + nothing)
+        else:
+            positions = self._hash_on(on, left_key)
+            found = []
+            for cells in other._iter_table():
+                key = right_key(cells)
+                if blank(key):
+                    continue
+                matches = positions.get(key)
+                if matches:
+                    found.extend((i, other_cells(cells)) for i in matches)
+            if how == 'left':
+                matched = set(i for i, cells in found)
+                nothing = ('',) * len(extra)
+                found.extend((i, nothing) for i in xrange(len(self.table))
+                    if i not in matched)
+            # stable, so several matches for a row stay in order
+            found.sort(key=itemgetter(0))
+            left = self.table
+            rows = [list(left[i]) + list(cells) for i, cells in found]
+
+        formatting.update(self.formatting)
+        style.update(self.style)
+        types.update(self.options.get('types', {}))
+        options = self.options.copy()
+        options.pop('columns', None)
+        options.update(formatting=formatting, style=style, types=types)
+        rows.insert(0, columns)
+        return TableFu(rows, **options)
+
+    def _hash_on(self, columns, key):
+        """
+        A dict of row positions for each key in columns, using
+        a hash index if there is one on a single column
+        """
+        if len(columns) == 1:
+            index = self.indexes.get(columns[0])
+            if index is not None and index.kind == 'hash':
+                return index.positions
+        positions = {}
+        for i, cells in enumerate(self.table):
+            value = key(cells)
+            try:
+                positions[value].append(i)
+            except KeyError:
+                positions[value] = array('l', [i])
+        return positions
+
     def transpose(self):
-        table = copy(self.table)
+        table = list(self.table)
         table.insert(0, self.default_columns)
         result = [
             [row[i] for row in table]
@@ -238,38 +1217,91 @@ class TableFu(object):
     
     def map(self, func, *columns):
         """
-        Map a function to rows, or to given columns
+        Map a function to rows, or to given columns. A lazy
+        table streams its rows once, keeping only those columns.
         """
         if not columns:
             return map(func, self.rows)
+        indexes = [self._index(column) for column in columns]
+        if len(columns) == 1:
+            return map(func, self._column(indexes[0]))
+        if self.lazy:
+            values = [[] for i in indexes]
+            for row in self._iter_table():
+                for i, column in izip(indexes, values):
+                    column.append(row[i])
         else:
-            values = (self.values(column) for column in columns)
-            result = [map(func, v) for v in values]
-            if len(columns) == 1:
-                return result[0]
-            else:
-                return result
+            values = [self._column(i) for i in indexes]
+        return [map(func, v) for v in values]
     
     # export methods
     def html(self):
-        table = '<table>\n%s\n%s\n</table>'
-        thead = '<thead>\n<tr>%s</tr>\n</thead>' % ''.join(['<th>%s</th>' % col for col in self.columns])
-        tbody = '<tbody>\n%s\n</tbody>' % '\n'.join([row.as_tr() for row in self.rows])
-        return table % (thead, tbody)
+        return ''.join(self.iter_html())
+
+    def iter_html(self, chunk_rows=1000):
+        """
+        Yield this table as HTML in chunks of chunk_rows rows,
+        so it can be streamed without building it all at once.
+        Joined together, the chunks are the same as html().
+        """
+        if chunk_rows < 1:
+            raise ValueError("chunk_rows must be at least 1")
+        thead = '<thead>\n<tr>%s</tr>\n</thead>' % ''.join([h.as_th() for h in self.headers])
+        yield '<table>\n%s\n<tbody>\n' % thead
+        rows = []
+        separator = ''
+        for row in self.iter_rows(True):
+            rows.append(row.as_tr())
+            if len(rows) == chunk_rows:
+                yield separator + '\n'.join(rows)
+                separator = '\n'
+                rows = []
+        if rows:
+            yield separator + '\n'.join(rows)
+        yield '\n</tbody>\n</table>'
+
+    def write_html(self, fp, chunk_rows=1000, encoding='utf-8'):
+        """
+        Write this table as HTML to a file-like object, a chunk
+        at a time. Unicode chunks are encoded, unless encoding
+        is None.
+        """
+        for chunk in self.iter_html(chunk_rows):
+            if encoding and isinstance(chunk, unicode):
+                chunk = chunk.encode(encoding)
+            fp.write(chunk)
     
     def csv(self, **kwargs):
         """
         Export this table as a CSV
         """
+        # DictWriter options, which don't apply to plain rows
+        kwargs.pop('restval', None)
+        kwargs.pop('extrasaction', None)
         out = StringIO()
-        writer = csv.DictWriter(out, self.columns, **kwargs)
-        writer.writerow(dict(zip(self.columns, self.columns)))
-        writer.writerows(dict(row.items()) for row in self.rows)
-        
+        self.write_csv(out, **kwargs)
         return out
+
+    def write_csv(self, fp, formatted=False, chunk_rows=1000, encoding='utf-8', **kwargs):
+        """
+        Write this table as a CSV to a file-like object, a chunk
+        of rows at a time. Cells are written as they are, or with
+        formatted=True, as they'd show up in html(), with unicode
+        encoded. Other keyword arguments go to csv.writer.
+        """
+        columns = self.columns
+        writer = csv.writer(fp, **kwargs)
+        writer.writerow(columns)
+        rows = self._iter_table()
+        if formatted:
+            plan = self._render_plan()
+            rows = _formatted_rows(rows, [plan[name] for name in columns], encoding)
+        elif columns != self.default_columns:
+            rows = _project_rows(rows, self.schema.projection())
+        _write_chunks(writer, rows, chunk_rows)
     
     def dict(self):
-        return (dict(row.items()) for row in self.rows)
+        return (dict(row.items()) for row in self.iter_rows(True))
     
     def json(self, **kwargs):
         if not has_json:
@@ -281,11 +1313,85 @@ class TableFu(object):
     def from_file(fn, **options):
         """
         Creates a new TableFu instance from a file or path
+
+        Passing mmap=True with a path maps the file into memory
+        and indexes where each row starts, parsing rows only
+        when they're used. The table is copied into memory if
+        it's changed.
+
+        Passing workers=N and columnar=True with a path splits
+        the file into N chunks, then parses and packs each one's
+        columns in its own process, if there's more than one CPU.
+        Row tables are always parsed in this process: building
+        their rows here costs about as much as parsing them.
+
+        Passing cache_dir with a path keeps a parsed copy of the
+        file in that directory, which is used until the file
+        changes. The cache is kept under cache_size bytes. Cached
+        tables are loaded column by column, as a ColumnarTable of
+        the parsed strings, or with columnar=True, packed numbers.
         """
         if hasattr(fn, 'read'):
             return TableFu(fn, **options)
+        cache_dir = options.pop('cache_dir', None)
+        if cache_dir is not None:
+            return TableFu._from_cache(fn, cache_dir, options)
+        if options.pop('mmap', False):
+            table = MappedTable(fn, options.pop('dialect', 'excel'))
+            return TableFu(table, **options)
+        workers = options.pop('workers', None)
+        if workers > 1 and options.get('columnar', False) and cpu_count() > 1:
+            table = parse_parallel(fn, workers, options.pop('dialect', 'excel'), True)
+            return TableFu(table, **options)
+        if options.get('lazy'):
+            return TableFu(_read_lines(fn), **options)
         with open(fn) as f:
             return TableFu(f, **options)
+
+    @staticmethod
+    def _from_cache(fn, cache_dir, options):
+        """
+        Load a path through a TableCache, parsing and
+        storing it if it isn't cached yet
+        """
+        cache = TableCache(cache_dir, options.pop('cache_size', None))
+        parse_options = {}
+        for name in ('dialect', 'workers'):
+            if name in options:
+                parse_options[name] = options.pop(name)
+        options.pop('lazy', None)
+        options.pop('mmap', None)
+
+        key = cache.key(fn, parse_options.get('dialect', 'excel'))
+        entry = cache.get(key, options.get('columnar', False))
+        if entry is None:
+            parsed = TableFu.from_file(fn, **parse_options)
+            header, rows, types = parsed.default_columns, parsed.table, {}
+            if options.get('infer_types', False):
+                for i, column_name in enumerate(header):
+                    name = converter_name(infer_converter(parsed._column(i)))
+                    if name is not None:
+                        types[column_name] = name
+            cache.put(key, header, rows, types)
+        else:
+            header, rows, types = entry
+
+        if getattr(rows, 'header', None) is None:
+            rows.insert(0, header)
+        table = TableFu(rows, **options)
+        if options.get('infer_types', False):
+            for column_name, name in types.items():
+                table._inferred.setdefault(table._index(column_name), get_converter(name))
+        return table
+
+    @staticmethod
+    def stream(fn, **options):
+        """
+        Creates a lazy TableFu instance from a file or path,
+        reading rows only as they're used
+        """
+        options['lazy'] = True
+        return TableFu.from_file(fn, **options)
     
     @staticmethod
     def from_url(url, **options):
@@ -296,6 +1402,118 @@ class TableFu(object):
         resp = urllib2.urlopen(url)
         return TableFu(resp, **options)
 
+    @staticmethod
+    def from_urls(urls, concurrency=4, timeout=None, **options):
+        """
+        Downloads several URLs at once, with at most `concurrency`
+        requests open, and returns a list of TableFu instances in
+        the same order. Connections to the same host are reused,
+        so each response is read in full, even with lazy=True.
+        """
+        # a lazy table would still be reading when its connection is reused
+        options.pop('lazy', None)
+
+        def load(lines):
+            return TableFu(lines, **options)
+        return load_all(urls, load, concurrency, timeout)
+
+
+class Schema(object):
+    """
+    Column lookups for a table.
+
+    A schema maps each of a table's default columns to
+    its position and keeps the positions of the columns
+    currently being shown, so rows don't have to search
+    the list of columns for every cell.
+    """
+    def __init__(self, default_columns, columns=None):
+        self.default_columns = list(default_columns)
+        self.columns = list(columns or self.default_columns)
+        self.indexes = {}
+        for i, name in enumerate(self.default_columns):
+            self.indexes.setdefault(name, i)
+        self.positions = [self.indexes.get(name) for name in self.columns]
+        self.missing = [
+            name for name, i in zip(self.columns, self.positions) if i is None
+        ]
+
+    def __repr__(self):
+        return "<Schema: %s>" % ', '.join(self.columns)
+
+    def projection(self):
+        """
+        Positions of the shown columns, raising KeyError
+        if any of them isn't in the table
+        """
+        if self.missing:
+            raise KeyError("%s isn't a column in this table" % self.missing[0])
+        return self.positions
+
+
+class VersionedDict(dict):
+    "A dict that counts its changes"
+    changes = 0
+
+    def _changed(method):
+        def wrapper(self, *args, **kwargs):
+            self.changes += 1
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    clear = _changed(dict.clear)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    del _changed
+
+
+class ColumnFormatting(VersionedDict):
+    "One column's formatting: its filter, args and options"
+
+
+class Formatting(VersionedDict):
+    """
+    A table's formatting, which counts its changes so compiled
+    formatting can tell when it's out of date. Each column's
+    settings are copied into a ColumnFormatting, so changing
+    them in place, like formatting['Price']['filter'] = 'dollars',
+    is seen too. Settings nested deeper, like a filter's options,
+    need setting again.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.update(*args, **kwargs)
+        self.changes = 0
+
+    @staticmethod
+    def _wrap(spec):
+        if isinstance(spec, dict) and not isinstance(spec, ColumnFormatting):
+            return ColumnFormatting(spec)
+        return spec
+
+    def __setitem__(self, column_name, spec):
+        VersionedDict.__setitem__(self, column_name, self._wrap(spec))
+
+    def setdefault(self, column_name, spec=None):
+        if column_name not in self:
+            self[column_name] = spec
+        return self[column_name]
+
+    def update(self, *args, **kwargs):
+        for column_name, spec in dict(*args, **kwargs).iteritems():
+            self[column_name] = spec
+
+    @property
+    def version(self):
+        "Changes to this and to each column's settings"
+        return (self.changes,) + tuple(getattr(spec, 'changes', 0)
+            for spec in self.itervalues())
+
 
 class Row(object):
     """
@@ -304,11 +1522,21 @@ class Row(object):
     Rows act like dictionaries, but look more like lists.
     Calling row['column'] returns a column lookup based on
     the default set of columns.
+
+    A row shares its cells with the table until one of
+    them is set, when it makes its own copy.
     """
+    __slots__ = ('table', 'row_num', 'cells', '_shared')
+
     def __init__(self, cells, row_num, table):
         self.table = table
         self.row_num = row_num
-        self.cells = list(cells)
+        if type(cells) is list:
+            self.cells = cells
+            self._shared = True
+        else:
+            self.cells = list(cells)
+            self._shared = False
 
     def __eq__(self, other):
         if not type(other) == type(self):
@@ -327,16 +1555,17 @@ class Row(object):
         """
         Return the Datum for column_name, or default.
         """
-        if column_name in self.table.default_columns:
-            index = self.table.default_columns.index(column_name)
-            return Datum(self.cells[index], self.row_num, column_name, self.table)
-        return default
+        index = self.table.schema.indexes.get(column_name)
+        if index is None:
+            return default
+        return Datum(self.cells[index], self.row_num, column_name, self.table, self.cells)
     
     def keys(self):
         return self.table.columns
     
     def values(self):
-        return [d.value for d in self.data]
+        cells = self.cells
+        return [cells[i] for i in self.table.schema.projection()]
     
     def items(self):
         return zip(self.keys(), self.values())
@@ -353,9 +1582,12 @@ class Row(object):
         """
         Set the value for a given cell
         """
-        if not column_name in self.table.default_columns:
+        index = self.table.schema.indexes.get(column_name)
+        if index is None:
             raise KeyError("%s isn't a column in this table" % column_name)
-        index = self.table.default_columns.index(column_name)
+        if self._shared:
+            self.cells = list(self.cells)
+            self._shared = False
         self.cells[index] = value
     
     def __iter__(self):
@@ -369,26 +1601,41 @@ class Row(object):
         return "<%s: %s>" % (self.__class__.__name__, self.__str__())
 
     def __str__(self):
-        return ', '.join(str(self[column]) for column in self.table.columns)
+        return ', '.join(str(d) for d in self.data)
     
     def as_tr(self):
-        cells = ''.join(d.as_td() for d in self.data)
-        return '<tr id="row%s" class="row %s">%s</tr>' % (self.row_num, odd_even(self.row_num), cells)
+        cells, table = self.cells, self.table
+        plan, style = table._render_plan(), table.style
+        schema = table.schema
+        schema.projection()
+        tds = ''.join([
+            '<td style="%s" class="datum">%s</td>' % (style.get(name) or '', plan[name](cells))
+            for name in schema.columns
+        ])
+        return '<tr id="row%s" class="row %s">%s</tr>' % (self.row_num, odd_even(self.row_num), tds)
         
     @property
     def data(self):
-        return [self[col] for col in self.table.columns]
+        cells, row_num, table = self.cells, self.row_num, self.table
+        schema = table.schema
+        return [
+            Datum(cells[i], row_num, name, table, cells)
+            for name, i in zip(schema.columns, schema.projection())
+        ]
 
 
 class Datum(object):
     """
     A piece of data, with a table, row and column
     """
-    def __init__(self, value, row_num, column_name, table):
+    __slots__ = ('value', 'row_num', 'column_name', 'table', 'cells')
+
+    def __init__(self, value, row_num, column_name, table, cells=None):
         self.value = value
         self.row_num = row_num
         self.column_name = column_name
         self.table = table
+        self.cells = cells
 
     def __repr__(self):
         return "<%s: %s>" % (self.column_name, self.value)
@@ -399,15 +1646,15 @@ class Datum(object):
         version of value, then fall back to the default value
         if there's no set formatting.
         """
-        if self.table.formatting.has_key(self.column_name):
-            func = self.table.formatting[self.column_name].get('filter', None)
-            args = self.table.formatting[self.column_name].get('args', [])
-            kwargs = self.table.formatting[self.column_name].get('options', {})
-            if func:
-                row = self.table[self.row_num]
-                args = [row[arg].value for arg in args]
-                return format(self.value, func, *args, **kwargs)
-        return self.value
+        render = self.table._render_plan().get(self.column_name)
+        if render is None:
+            if not isinstance(self.value, basestring):
+                return str(self.value)
+            return self.value
+        cells = self.cells
+        if cells is None:
+            cells = self.table[self.row_num].cells
+        return render(cells)
     
     def __eq__(self, other):
         if type(other) == type(self):
@@ -415,6 +1662,20 @@ class Datum(object):
         else:
             return self.value == other
     
+    @property
+    def typed_value(self):
+        """
+        This datum's value converted to its column's type,
+        or the raw value if the column isn't typed
+        """
+        func = self.table.column_type(self.column_name)
+        if func is None or is_blank(self.value):
+            return self.value
+        try:
+            return func(self.value)
+        except (ValueError, TypeError, InvalidOperation):
+            return self.value
+
     def as_td(self):
         return '<td style="%s" class="datum">%s</td>' % (self.style or '', self.__str__())
     
@@ -430,6 +1691,8 @@ class Header(object):
     """
     A header row on a column.
     """
+    __slots__ = ('name', 'col_num', 'table')
+
     def __init__(self, name, col_num, table):
         self.name = name
         self.col_num = col_num
@@ -439,7 +1702,10 @@ class Header(object):
         return "<Header: %s>" % (self.name)
         
     def __str__(self):
-        return self.name.encode('utf-8')
+        # csv gives byte strings, which are already encoded
+        if isinstance(self.name, unicode):
+            return self.name.encode('utf-8')
+        return self.name
     
     def __eq__(self, other):
         if type(other) == type(self):
@@ -458,6 +1724,40 @@ class Header(object):
     style = property(_get_style)
 
 
+def _read_lines(fn):
+    """
+    Yield lines from a path, closing the file once
+    every line has been read
+    """
+    with open(fn) as f:
+        for line in f:
+            yield line
+
+
+def _project_rows(rows, positions):
+    "Keep the cells at positions from each row"
+    for cells in rows:
+        yield [cells[i] for i in positions]
+
+
+def _formatted_rows(rows, renderers, encoding):
+    "Render each row's cells, encoding any unicode"
+    for cells in rows:
+        values = [render(cells) for render in renderers]
+        yield [isinstance(v, unicode) and v.encode(encoding) or v for v in values]
+
+
+def _write_chunks(writer, rows, chunk_rows):
+    "Write rows to a csv writer, chunk_rows at a time"
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows must be at least 1")
+    rows = iter(rows)
+    chunk = list(islice(rows, chunk_rows))
+    while chunk:
+        writer.writerows(chunk)
+        chunk = list(islice(rows, chunk_rows))
+
+
 def odd_even(num):
     if num % 2 == 0:
         return "even"
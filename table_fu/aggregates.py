@@ -0,0 +1,405 @@
+"""
+Grouping and aggregating TableFu tables.
+
+    >>> from table_fu.aggregates import count, Mean
+    >>> table.group_by('Style').aggregate(
+    ...     pages=('Number of Pages', 'sum'),
+    ...     average=Mean('Number of Pages'),
+    ...     books=count,
+    ... )
+
+Every aggregate is computed in one pass over the table, keeping
+a running state for each group in a dict keyed on the group's
+values.
+
+An aggregate can be given as:
+ - a (column, name) pair, where name is sum, count, mean, min or max
+ - a (column, function) pair, where the function gets a list of
+   that column's values for each group
+ - an Aggregate, like count or Mean('Number of Pages')
+ - a function, which gets a list of each group's rows
+"""
+from table_fu.converters import is_blank
+
+
+class Aggregate(object):
+    """
+    A running calculation over one column's values.
+
+    Subclasses define start, step and finish. The state
+    returned by start is passed to step for each value,
+    and finish turns it into the result.
+
+    Which values step gets depends on `values`: 'raw' cells,
+    'typed' values for typed columns (raw cells otherwise),
+    'numeric', which reads untyped columns as floats, or
+    'comparable', which gives (value, cell) pairs: typed values
+    twice, or for untyped columns the cell as a float (None if
+    it isn't a number) and the cell itself. Blank cells are None
+    in typed, numeric and comparable columns.
+    """
+    values = 'raw'
+
+    def __init__(self, column_name=None):
+        self.column_name = column_name
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.column_name or '*')
+
+    def start(self):
+        return None
+
+    def step(self, state, value):
+        return state
+
+    def finish(self, state):
+        return state
+
+
+class Count(Aggregate):
+    "The number of rows, or of non-blank values in a column"
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        if self.column_name is None or not is_blank(value):
+            return state + 1
+        return state
+
+
+class Sum(Aggregate):
+    values = 'numeric'
+
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return state + value
+
+
+class Mean(Aggregate):
+    values = 'numeric'
+
+    def start(self):
+        return [0, 0]
+
+    def step(self, state, value):
+        if value is not None:
+            state[0] += value
+            state[1] += 1
+        return state
+
+    def finish(self, state):
+        if not state[1]:
+            return None
+        return float(state[0]) / state[1]
+
+
+class Extreme(Aggregate):
+    """
+    The smallest or largest value. Untyped cells are compared
+    as numbers, or as text if any in the group isn't a number.
+    """
+    values = 'comparable'
+
+    def start(self):
+        # the best number, the best cell, and whether every cell was a number
+        return [None, None, True]
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        number, cell = value
+        if number is None:
+            state[2] = False
+        elif state[2] and (state[0] is None or self.better(number, state[0])):
+            state[0] = number
+        if state[1] is None or self.better(cell, state[1]):
+            state[1] = cell
+        return state
+
+    def finish(self, state):
+        if state[2]:
+            return state[0]
+        return state[1]
+
+
+class Min(Extreme):
+    def better(self, value, best):
+        return value < best
+
+
+class Max(Extreme):
+    def better(self, value, best):
+        return value > best
+
+
+class Collect(Aggregate):
+    """
+    Collects a group's values (or rows) into a list
+    and passes it to a function at the end
+    """
+    values = 'typed'
+
+    def __init__(self, column_name, func):
+        self.column_name = column_name
+        self.func = func
+
+    def start(self):
+        return []
+
+    def step(self, state, value):
+        state.append(value)
+        return state
+
+    def finish(self, state):
+        return self.func(state)
+
+
+AGGREGATES = {
+    'count': Count,
+    'sum': Sum,
+    'mean': Mean,
+    'min': Min,
+    'max': Max,
+}
+
+count = Count()
+
+
+def make_aggregate(spec):
+    "Turns any of the ways of naming an aggregate into an Aggregate"
+    if isinstance(spec, Aggregate):
+        return spec
+    if isinstance(spec, (tuple, list)) and len(spec) == 2:
+        column_name, kind = spec
+        if isinstance(kind, basestring):
+            try:
+                return AGGREGATES[kind](column_name)
+            except KeyError:
+                raise ValueError("%s isn't a known aggregate" % kind)
+        if isinstance(kind, type) and issubclass(kind, Aggregate):
+            return kind(column_name)
+        if isinstance(kind, Aggregate):
+            aggregate = kind.__class__.__new__(kind.__class__)
+            aggregate.__dict__.update(kind.__dict__)
+            aggregate.column_name = column_name
+            return aggregate
+        if callable(kind):
+            return Collect(column_name, kind)
+    elif callable(spec):
+        return Collect(None, spec)
+    raise TypeError("Can't aggregate %r" % (spec,))
+
+
+class GroupBy(object):
+    """
+    A table grouped on one or more columns, waiting to be
+    aggregated. Groups come out sorted by their values.
+    """
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = list(columns)
+        self.indexes = [table._index(c) for c in self.columns]
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, ', '.join(self.columns))
+
+    def _getter(self, aggregate):
+        """
+        Returns a function of (cells, row_num) giving the value
+        an aggregate steps over
+        """
+        table = self.table
+        if aggregate.column_name is None:
+            if isinstance(aggregate, Collect):
+                from table_fu import Row
+                return lambda cells, i: Row(cells, i, table)
+            return lambda cells, i: None
+
+        index = table._index(aggregate.column_name)
+        func = None
+        if aggregate.values != 'raw':
+            func = table.column_type(aggregate.column_name)
+        if aggregate.values == 'comparable':
+            return self._pair_getter(index, func, aggregate.column_name)
+        if func is None:
+            if aggregate.values != 'numeric':
+                return lambda cells, i: cells[index]
+            func = float
+        elif not table.lazy:
+            typed = table.typed_values(aggregate.column_name)
+            return lambda cells, i: typed[i]
+        column_name = aggregate.column_name
+
+        def convert(cells, i):
+            value = cells[index]
+            if is_blank(value):
+                return None
+            try:
+                return func(value)
+            except (ValueError, TypeError):
+                raise ValueError('Column %s contains non-numeric values' % column_name)
+        return convert
+
+    def _pair_getter(self, index, func, column_name):
+        "Gets (value, cell) pairs for 'comparable' aggregates"
+        table = self.table
+        if func is not None and not table.lazy:
+            typed = table.typed_values(column_name)
+            def typed_pair(cells, i):
+                value = typed[i]
+                if value is None:
+                    return None
+                return value, value
+            return typed_pair
+
+        def pair(cells, i):
+            cell = cells[index]
+            if is_blank(cell):
+                return None
+            if func is not None:
+                try:
+                    value = func(cell)
+                except (ValueError, TypeError):
+                    raise ValueError('Column %s contains values that can\'t be converted'
+                        % column_name)
+                return value, value
+            try:
+                return float(cell), cell
+            except (ValueError, TypeError):
+                return None, cell
+        return pair
+
+    def aggregate(self, **specs):
+        """
+        Computes each named aggregate for every group in one
+        pass, returning a new TableFu with the group columns
+        followed by the aggregates, in order of their names.
+        """
+        names = sorted(specs)
+        aggregates = [make_aggregate(specs[name]) for name in names]
+        getters = [self._getter(a) for a in aggregates]
+        steps = zip(range(len(aggregates)), [a.step for a in aggregates], getters)
+        key_indexes = self.indexes
+
+        groups = {}
+        for i, cells in enumerate(self.table._iter_table()):
+            key = tuple([cells[k] for k in key_indexes])
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = [a.start() for a in aggregates]
+            for n, step, get in steps:
+                states[n] = step(states[n], get(cells, i))
+
+        rows = [self.columns + names]
+        for key in sorted(groups):
+            states = groups[key]
+            rows.append(list(key) + [a.finish(s) for a, s in zip(aggregates, states)])
+
+        formatting = dict(
+            (c, f) for c, f in self.table.formatting.items() if c in self.columns
+        )
+        return self.table.__class__(rows, formatting=formatting)
+
+    def count(self):
+        "Shortcut for aggregate(count=count)"
+        return self.aggregate(count=count)
+
+
+class RunningTotals(object):
+    """
+    Sum, count, min, max and mean of one column, kept up to
+    date as values are added and removed, each in constant time.
+
+    Min and max keep a count of each value, so only removing the
+    last copy of the smallest or largest value has to look for
+    the next one.
+
+        >>> totals = table.track('Number of Pages')
+        >>> totals['sum'], totals['max']
+    """
+    KINDS = ('sum', 'count', 'min', 'max', 'mean')
+
+    def __init__(self, column_name, aggregates=KINDS, func=None):
+        for name in aggregates:
+            if name not in self.KINDS:
+                raise ValueError("%s isn't an aggregate that can be tracked" % name)
+        self.column_name = column_name
+        self.aggregates = list(aggregates)
+        self.func = func or float
+        self.clear()
+
+    def __repr__(self):
+        return "<%s: %s, %s>" % (self.__class__.__name__, self.column_name,
+            ', '.join('%s=%s' % item for item in self.items()))
+
+    def clear(self):
+        self.sum = 0
+        self.count = 0
+        self.min = self.max = None
+        if 'min' in self.aggregates or 'max' in self.aggregates:
+            self.counts = {}
+        else:
+            self.counts = None
+
+    def convert(self, cell):
+        "Read a raw cell as a value, or None if it's blank"
+        if is_blank(cell):
+            return None
+        try:
+            return self.func(cell)
+        except (ValueError, TypeError, ArithmeticError):
+            raise ValueError('Column %s contains non-numeric values' % self.column_name)
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        if 'sum' in self.aggregates or 'mean' in self.aggregates:
+            self.sum += value
+        counts = self.counts
+        if counts is not None:
+            counts[value] = counts.get(value, 0) + 1
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def remove(self, value):
+        if value is None:
+            return
+        self.count -= 1
+        if 'sum' in self.aggregates or 'mean' in self.aggregates:
+            self.sum -= value
+        counts = self.counts
+        if counts is not None:
+            n = counts.pop(value) - 1
+            if n:
+                counts[value] = n
+            elif not counts:
+                self.min = self.max = None
+            elif value == self.min:
+                self.min = min(counts)
+            elif value == self.max:
+                self.max = max(counts)
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.sum) / self.count
+
+    def __getitem__(self, name):
+        if name not in self.aggregates:
+            raise KeyError("%s isn't tracked for %s" % (name, self.column_name))
+        return getattr(self, name)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.aggregates]
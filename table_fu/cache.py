@@ -0,0 +1,176 @@
+"""
+An on-disk cache of parsed tables.
+
+Tables are stored column by column with marshal, each column as
+one NUL-joined string, plus the bytes of an array for integer and
+float columns. Loading an entry reads a few long strings instead of
+an object per cell, and gives back a ColumnarTable, which builds
+rows only as they're used: of strings, or with columnar=True, with
+numeric columns loaded straight into arrays.
+Entries are keyed by a file's path, size, modification time
+and an MD5 hash of its contents, so a changed file is never
+served from the cache, along with the csv dialect it was
+parsed with. When the cache grows past its size
+limit, the least recently used entries are removed.
+"""
+from __future__ import with_statement
+
+import csv
+import marshal
+import os
+import tempfile
+from hashlib import md5, sha1
+from itertools import izip
+
+from table_fu.columnar import SEPARATOR, ColumnarTable, infer_column, load_columns
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+SUFFIX = '.tablefu'
+DIALECT_ATTRS = ('delimiter', 'quotechar', 'escapechar', 'doublequote',
+    'skipinitialspace', 'lineterminator', 'quoting')
+
+
+def fingerprint(path, blocksize=1 << 20):
+    """
+    Returns a key for a file, based on its path, size,
+    modification time and contents
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digest = md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    key = '%s|%s|%s|%s' % (path, stat.st_size, stat.st_mtime, digest.hexdigest())
+    return sha1(key).hexdigest()
+
+
+def describe_dialect(dialect):
+    "The settings of a csv dialect, given by name or as a dialect, as a string"
+    if isinstance(dialect, basestring):
+        dialect = csv.get_dialect(dialect)
+    return '|'.join([repr(getattr(dialect, name, None)) for name in DIALECT_ATTRS])
+
+
+class TableCache(object):
+    """
+    A directory of parsed tables.
+
+    Each entry holds a table's header, its columns (or its rows,
+    if they differ in length) and the names of any column types
+    inferred for it.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        if max_size is None:
+            max_size = DEFAULT_CACHE_SIZE
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def key(self, path, dialect='excel'):
+        "A key for a file, as parsed with a csv dialect"
+        return sha1(fingerprint(path) + describe_dialect(dialect)).hexdigest()
+
+    def get(self, key, columnar=False):
+        """
+        Returns (header, rows, types) for a key, or None if it
+        isn't cached. Rows come back as a ColumnarTable with the
+        header, of strings, or with columnar=True, with packed
+        numeric columns. Unreadable entries are removed.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = marshal.load(f)
+            if data[0] != CACHE_VERSION:
+                raise ValueError("Old cache entry")
+            version, header, length, columns, rows, types = data
+        except IOError:
+            return None
+        except (EOFError, ValueError, TypeError, IndexError):
+            self._remove(path)
+            return None
+        # mark this entry as recently used
+        os.utime(path, None)
+        if columns is None:
+            # rows of different lengths, stored as they are
+            if columnar:
+                rows = ColumnarTable.from_columns(ColumnarTable(rows).columns, header)
+            return header, rows, types
+        if columnar:
+            dumped = [(typecode, typecode and packed or strings)
+                for typecode, packed, strings in columns]
+        else:
+            dumped = [(None, strings) for typecode, packed, strings in columns]
+        table = ColumnarTable.from_columns(load_columns(dumped, length), header)
+        return header, table, types
+
+    def put(self, key, header, rows, types=None):
+        "Store a parsed table, then trim the cache to size"
+        rows = [list(row) for row in rows]
+        length, columns = len(rows), None
+        if len(set(map(len, rows))) == 1:
+            columns = []
+            for strings in izip(*rows):
+                column = infer_column(list(strings))
+                typecode = getattr(column, 'typecode', None)
+                packed = typecode and column.tostring() or None
+                columns.append((typecode, packed, SEPARATOR.join(strings)))
+            rows = None
+        data = (CACHE_VERSION, list(header), length, columns, rows, types or {})
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(data, f)
+            os.rename(tmp, self._path(key))
+        except:
+            self._remove(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        "Returns (last used, size, path) for each entry, oldest first"
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def size(self):
+        "The total size of every entry, in bytes"
+        return sum(size for used, size, path in self.entries())
+
+    def evict(self):
+        "Remove the least recently used entries until the cache fits"
+        entries = self.entries()
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for used, size, path in self.entries():
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,293 @@
+"""
+Column-oriented storage for TableFu.
+
+A ColumnarTable keeps each column in its own container:
+an array('l') for integers, an array('d') for floats and
+a plain list for everything else. It acts enough like a
+list of rows that TableFu, Row and Datum don't need to
+know the difference.
+
+    >>> table = ColumnarTable([['a', '1', '1.5'], ['b', '2', '2.5']])
+    >>> table.typecodes
+    [None, 'l', 'd']
+    >>> table[1]
+    ['b', 2, 2.5]
+
+Columns can also be dumped to a pair of strings each, an array's
+bytes or a list's strings joined by NUL bytes (which the csv module
+never parses), so they can be stored or sent between processes and
+loaded back without building an object per cell on the way.
+"""
+from __future__ import with_statement
+
+import gc
+from array import array
+from contextlib import contextmanager
+from itertools import imap, izip
+
+SEPARATOR = '\0'
+
+
+@contextmanager
+def paused_gc():
+    """
+    Turn off cyclic garbage collection while building lots of
+    lists of strings, which can't form cycles. Otherwise the
+    collector runs over every row built so far, again and again.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def infer_column(values):
+    """
+    Returns a compact container for a list of strings.
+
+    Columns where every value converts to an int (or a float)
+    and back to the same string are stored as typed arrays.
+    Anything else, including columns with blanks, stays a list.
+    """
+    for typecode, func in (('l', int), ('d', float)):
+        try:
+            converted = map(func, values)
+            if map(str, converted) == values:
+                return array(typecode, converted)
+        except (ValueError, TypeError, OverflowError):
+            continue
+    return list(values)
+
+
+def pack_column(values):
+    """
+    Returns a compact container for a list of Python values,
+    as produced by a transform function.
+    """
+    values = list(values)
+    for typecode, kind in (('l', int), ('d', float)):
+        if values and all(type(v) is kind for v in values):
+            try:
+                return array(typecode, values)
+            except OverflowError:
+                break
+    return values
+
+
+def as_strings(column):
+    "A column's values as the strings they were parsed from"
+    if isinstance(column, array):
+        # infer_column only packs values that read back the same
+        return map(str, column)
+    return column
+
+
+def dump_columns(columns):
+    "Columns as (typecode, string) pairs, with None for lists"
+    dumped = []
+    for column in columns:
+        if isinstance(column, array):
+            dumped.append((column.typecode, column.tostring()))
+        else:
+            dumped.append((None, SEPARATOR.join(column)))
+    return dumped
+
+
+def load_columns(dumped, length):
+    "Columns back from dump_columns, for a table of length rows"
+    columns = []
+    for typecode, data in dumped:
+        if typecode is not None:
+            column = array(typecode)
+            column.fromstring(data)
+        elif length:
+            column = data.split(SEPARATOR)
+        else:
+            column = []
+        columns.append(column)
+    return columns
+
+
+def join_columns(parts):
+    """
+    A table's columns from the columns of consecutive chunks of it.
+    A column stays packed if it's packed the same way in every chunk,
+    just as infer_column would have packed the whole column.
+    """
+    columns = []
+    for chunks in izip(*parts):
+        typecodes = set([getattr(c, 'typecode', None) for c in chunks])
+        if len(typecodes) == 1 and None not in typecodes:
+            column = array(typecodes.pop())
+        else:
+            column = []
+            chunks = [as_strings(c) for c in chunks]
+        for chunk in chunks:
+            column.extend(chunk)
+        columns.append(column)
+    return columns
+
+
+def columns_to_rows(columns):
+    "Rows of strings from a table's columns"
+    columns = [as_strings(c) for c in columns]
+    with paused_gc():
+        return [list(row) for row in izip(*columns)]
+
+
+class ColumnarTable(object):
+    """
+    A table stored column by column.
+
+    Rows are built on the fly as lists, so changing a row
+    returned by table[n] doesn't change the table. Use
+    set_column (or TableFu.transform) to change values.
+    """
+    def __init__(self, rows, width=None):
+        rows = iter(rows)
+        if width is None:
+            try:
+                first = list(rows.next())
+            except StopIteration:
+                first = []
+            width = len(first)
+            strings = [[v] for v in first]
+        else:
+            strings = [[] for i in xrange(width)]
+
+        for row in rows:
+            for column, value in izip(strings, row):
+                column.append(value)
+
+        self.columns = [infer_column(column) for column in strings]
+
+    header = None
+
+    @classmethod
+    def from_columns(cls, columns, header=None):
+        "A table made straight from its columns, with an optional header"
+        table = cls.__new__(cls)
+        table.columns = list(columns)
+        table.header = header
+        return table
+
+    @property
+    def typecodes(self):
+        "The array typecode for each column, or None for lists"
+        return [getattr(c, 'typecode', None) for c in self.columns]
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return imap(list, izip(*self.columns))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return [column[index] for column in self.columns]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def column(self, index):
+        "Return the container for one column"
+        return self.columns[index]
+
+    def set_column(self, index, values):
+        "Replace a column's values, repacking them if possible"
+        self.columns[index] = pack_column(values)
+
+    def add_column(self, values):
+        "Add a column at the end, packing it if possible"
+        self.columns.append(pack_column(values))
+
+    def set(self, row, index, value):
+        "Set one cell, unpacking its column if the value doesn't fit"
+        column = self.columns[index]
+        if isinstance(column, array):
+            value = _coerce(column, value)
+            try:
+                column[row] = value
+                return
+            except (TypeError, OverflowError):
+                column = self.columns[index] = list(column)
+        column[row] = value
+
+    def append(self, row):
+        for i, value in enumerate(row):
+            column = self.columns[i]
+            if isinstance(column, array):
+                value = _coerce(column, value)
+                try:
+                    column.append(value)
+                    continue
+                except (TypeError, OverflowError):
+                    column = self.columns[i] = list(column)
+            column.append(value)
+
+    def insert(self, index, row):
+        for i, value in enumerate(row):
+            column = self.columns[i]
+            if isinstance(column, array):
+                value = _coerce(column, value)
+                try:
+                    column.insert(index, value)
+                    continue
+                except (TypeError, OverflowError):
+                    column = self.columns[i] = list(column)
+            column.insert(index, value)
+
+    def pop(self, index=-1):
+        return [column.pop(index) for column in self.columns]
+
+    def sort(self, key=None, reverse=False):
+        """
+        Sort rows in place. The key function gets each row
+        as a list, just like list.sort.
+        """
+        if key is None:
+            keys = list(self)
+        else:
+            keys = map(key, self)
+        order = sorted(xrange(len(keys)), key=keys.__getitem__, reverse=reverse)
+        self.reorder(order)
+
+    def reorder(self, order):
+        "Put rows in a new order, given as a list of row positions"
+        for i, column in enumerate(self.columns):
+            if isinstance(column, array):
+                self.columns[i] = array(column.typecode, [column[n] for n in order])
+            else:
+                self.columns[i] = [column[n] for n in order]
+
+
+def _coerce(column, value):
+    """
+    Convert a string to the type stored in a typed column,
+    as long as nothing is lost in the conversion
+    """
+    if not isinstance(value, basestring):
+        return value
+    func = column.typecode == 'l' and int or float
+    try:
+        converted = func(value)
+    except ValueError:
+        return value
+    if str(converted) == value:
+        return converted
+    return value
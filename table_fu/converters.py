@@ -0,0 +1,127 @@
+"""
+Functions to turn strings from a spreadsheet into Python values.
+
+Columns can be declared with a type name ('int', 'float',
+'decimal' or 'date') or any callable that takes a string,
+or their types can be inferred from their values.
+
+    >>> get_converter('int')('120')
+    120
+    >>> infer_converter(['120', '644', '']) is int
+    True
+"""
+import re
+from datetime import datetime
+from decimal import Decimal
+
+ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+ZERO_PADDED = re.compile(r'^-?0\d')
+
+
+def parse_date(value):
+    """
+    Parses an ISO-formatted date, like 2010-11-02,
+    into a datetime.date
+    """
+    if hasattr(value, 'year'):
+        return value
+    return datetime.strptime(value.strip(), '%Y-%m-%d').date()
+
+
+CONVERTERS = {
+    'int': int,
+    'float': float,
+    'decimal': Decimal,
+    'date': parse_date,
+}
+
+
+def get_converter(kind):
+    """
+    Returns a converter for a type name or callable
+    """
+    if callable(kind):
+        return kind
+    try:
+        return CONVERTERS[kind]
+    except KeyError:
+        raise ValueError("%s isn't a known column type" % kind)
+
+
+def converter_name(func):
+    """
+    Returns the name a converter is registered under,
+    or None for other callables
+    """
+    for name, converter in CONVERTERS.items():
+        if converter is func:
+            return name
+    return None
+
+
+def is_blank(value):
+    return value is None or value == ''
+
+
+def convert_column(values, func):
+    """
+    Converts every value in a column, leaving blanks as None.
+    Raises ValueError if a value can't be converted.
+    """
+    result = []
+    append = result.append
+    for value in values:
+        if is_blank(value):
+            append(None)
+        else:
+            append(func(value))
+    return result
+
+
+def _looks_like_int(value):
+    if ZERO_PADDED.match(value):
+        # codes like ZIPs and FIPS lose their meaning as numbers
+        return False
+    int(value)
+    return True
+
+
+def _looks_like_float(value):
+    if ZERO_PADDED.match(value):
+        return False
+    f = float(value)
+    return f == f and f not in (float('inf'), float('-inf'))
+
+
+def _looks_like_date(value):
+    if not ISO_DATE.match(value):
+        return False
+    parse_date(value)
+    return True
+
+
+INFERENCE = (
+    (int, _looks_like_int),
+    (float, _looks_like_float),
+    (parse_date, _looks_like_date),
+)
+
+
+def infer_converter(values):
+    """
+    Returns int, float or parse_date if every non-blank
+    value in a column can be read that way, or None.
+    Columns of blanks aren't given a type.
+    """
+    values = [v for v in values if not is_blank(v)]
+    if not values:
+        return None
+    if not all(isinstance(v, basestring) for v in values):
+        return None
+    for func, test in INFERENCE:
+        try:
+            if all(test(v) for v in values):
+                return func
+        except (ValueError, TypeError):
+            continue
+    return None
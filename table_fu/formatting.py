@@ -7,16 +7,7 @@ import re
 import statestyle
 
 
-def _saferound(value, decimal_places):
-    """
-    Rounds a float value off to the desired precision
-    """
-    try:
-        f = float(value)
-    except ValueError:
-        return ''
-    format = '%%.%df' % decimal_places
-    return format % f
+LEADING_DIGITS = re.compile(r'^(-?)(\d{4,})')
 
 
 def ap_state(value, failure_string=None):
@@ -107,11 +98,15 @@ def intcomma(value):
     For example, 3000 becomes '3,000' and 45000 becomes '45,000'.
     """
     orig = str(value)
-    new = re.sub("^(-?\d+)(\d{3})", '\g<1>,\g<2>', orig)
-    if orig == new:
-        return new
-    else:
-        return intcomma(new)
+    match = LEADING_DIGITS.match(orig)
+    if match is None:
+        return orig
+    sign, digits = match.groups()
+    # group the leading digits in threes, from the right
+    first = len(digits) % 3 or 3
+    groups = [digits[:first]]
+    groups.extend(digits[i:i + 3] for i in xrange(first, len(digits), 3))
+    return sign + ','.join(groups) + orig[match.end():]
 
 
 def percentage(value, decimal_places=1, multiply=True, failure_string='N/A'):
@@ -132,7 +127,7 @@ def percentage(value, decimal_places=1, multiply=True, failure_string='N/A'):
         return failure_string
     if multiply:
         value = value * 100
-    return _saferound(value, decimal_places) + '%'
+    return '%.*f%%' % (decimal_places, value)
 
 
 def percent_change(value, decimal_places=1, multiply=True, failure_string='N/A'):
@@ -153,11 +148,10 @@ def percent_change(value, decimal_places=1, multiply=True, failure_string='N/A')
             f = f * 100
     except ValueError:
        return  failure_string
-    s = _saferound(f, decimal_places)
     if f > 0:
-        return '+' + s + '%'
+        return '+%.*f%%' % (decimal_places, f)
     else:
-        return s + '%'
+        return '%.*f%%' % (decimal_places, f)
 
 
 def ratio(value, decimal_places=0, failure_string='N/A'):
@@ -170,7 +164,7 @@ def ratio(value, decimal_places=0, failure_string='N/A'):
         f = float(value)
     except ValueError:
         return failure_string
-    return _saferound(f, decimal_places) + ':1'
+    return '%.*f:1' % (decimal_places, f)
 
 
 def stateface(value):
@@ -241,6 +235,94 @@ DEFAULT_FORMATTERS = {
 }
 
 
+# how many results a cached filter keeps by default
+CACHE_SIZE = 1024
+
+_MARK = object()
+
+
+class CachedFilter(object):
+    """
+    A filter wrapped in a least-recently-used cache of its results,
+    keyed on the value and arguments (and their types) it's given.
+    Only filters that always return the same result for the same
+    arguments should be cached.
+
+    Counts of hits, misses and evictions are kept to show
+    whether the cache is paying off.
+    """
+    # parts of each link in the circular list of cached results
+    PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+
+    def __init__(self, func, maxsize=CACHE_SIZE):
+        self.func = func
+        self.maxsize = maxsize
+        self.__name__ = getattr(func, '__name__', 'filter')
+        self.__doc__ = func.__doc__
+        self.clear()
+
+    def __repr__(self):
+        return "<%s: %s, %s/%s>" % (self.__class__.__name__, self.__name__,
+            len(self.cache), self.maxsize)
+
+    def clear(self):
+        "Empty the cache and reset its counts"
+        self.cache = {}
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, value, *args, **kwargs):
+        key = (value, type(value))
+        if args or kwargs:
+            key += (_MARK,) + args + tuple(type(a) for a in args)
+            if kwargs:
+                key += (_MARK,) + tuple(sorted(kwargs.items()))
+        try:
+            link = self.cache.get(key)
+        except TypeError: # unhashable arguments aren't cached
+            return self.func(value, *args, **kwargs)
+
+        PREV, NEXT, RESULT = self.PREV, self.NEXT, self.RESULT
+        root = self.root
+        if link is not None:
+            # move to the front (the end just before root)
+            link[PREV][NEXT] = link[NEXT]
+            link[NEXT][PREV] = link[PREV]
+            last = root[PREV]
+            last[NEXT] = root[PREV] = link
+            link[PREV] = last
+            link[NEXT] = root
+            self.hits += 1
+            return link[RESULT]
+
+        result = self.func(value, *args, **kwargs)
+        self.misses += 1
+        if self.maxsize <= 0:
+            return result
+        if len(self.cache) >= self.maxsize:
+            # evict the oldest result, just after root
+            oldest = root[NEXT]
+            root[NEXT] = oldest[NEXT]
+            oldest[NEXT][PREV] = root
+            del self.cache[oldest[self.KEY]]
+            self.evictions += 1
+        last = root[PREV]
+        link = [last, root, key, result]
+        last[NEXT] = root[PREV] = self.cache[key] = link
+        return result
+
+    def info(self):
+        "Counts of hits, misses and evictions, and the cache's size"
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.cache),
+            'maxsize': self.maxsize,
+        }
+
+
 class Formatter(object):
     """
     A formatter is a function (or any callable, really)
@@ -263,10 +345,21 @@ class Formatter(object):
     '1,200'
     >>> formatter(1200, 'dollars')
     '$1,200'
+
+    Filters that see the same values over and over can cache
+    their results, either one at a time or all together:
+
+    >>> formatter.register('ap_state', ap_state, cache=True)
+    >>> formatter = Formatter(cache=True, cache_size=500)
+    >>> formatter.cache_info('ap_state')
+    {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0, 'maxsize': 500}
     """
     
-    def __init__(self):
+    def __init__(self, cache=False, cache_size=CACHE_SIZE):
         self._filters = {}
+        self.version = 0
+        self.cache = cache
+        self.cache_size = cache_size
         for name, func in DEFAULT_FORMATTERS.items():
             self.register(name, func)
     
@@ -274,8 +367,27 @@ class Formatter(object):
         if not callable(func):
             func = self._filters[func]
         return func(value, *args, **kwargs)
+
+    def many(self, values, func, *args, **kwargs):
+        """
+        Format every value in a sequence, like a column, with
+        the same filter and arguments, looking the filter up once
+
+        >>> format.many([1200, 45000], 'intcomma')
+        ['1,200', '45,000']
+        """
+        if not callable(func):
+            func = self._filters[func]
+        if args or kwargs:
+            return [func(value, *args, **kwargs) for value in values]
+        return map(func, values)
     
-    def register(self, name=None, func=None):
+    def register(self, name=None, func=None, cache=None, cache_size=None):
+        """
+        Register a filter under a name, or its own name.
+        Pass cache=True (or create the Formatter with cache=True)
+        to keep up to cache_size of its results.
+        """
         if not func and not name:
             return
 
@@ -284,8 +396,50 @@ class Formatter(object):
             name = func.__name__
         elif func and not name:
             name = func.__name__
+
+        if cache is None:
+            cache = self.cache
+        if isinstance(func, CachedFilter):
+            func = func.func
+        if cache:
+            func = CachedFilter(func, cache_size or self.cache_size)
         
         self._filters[name] = func
+        self.version += 1
+
+    def set_cache(self, cache=True, cache_size=None):
+        """
+        Turn caching on or off for every registered filter,
+        and for filters registered later. Filters that are
+        already cached keep their cache, size and counts;
+        cache_size sets the size of caches made from now on.
+        """
+        self.cache = cache
+        if cache_size:
+            self.cache_size = cache_size
+        for name, func in self._filters.items():
+            if bool(cache) != isinstance(func, CachedFilter):
+                self.register(name, func, cache)
+
+    def cache_info(self, name=None):
+        """
+        Hit, miss and eviction counts for a cached filter,
+        or a dict of them for every cached filter
+        """
+        if name is not None:
+            func = self._filters[name]
+            if not isinstance(func, CachedFilter):
+                raise ValueError("%s isn't cached" % name)
+            return func.info()
+        return dict(
+            (name, func.info()) for name, func in self._filters.items()
+            if isinstance(func, CachedFilter)
+        )
+
+    def clear_cache(self):
+        for func in self._filters.values():
+            if isinstance(func, CachedFilter):
+                func.clear()
     
     def unregister(self, name=None, func=None):
         if not func and not name:
@@ -297,6 +451,7 @@ class Formatter(object):
             return
         
         del self._filters[name]
+        self.version += 1
         
 
 # Unless you need to subclass or keep formatting functions
@@ -0,0 +1,176 @@
+"""
+Indexes on TableFu columns.
+
+A HashIndex maps each value in a column to the positions of
+the rows that hold it, so equality filters, unique values and
+facets don't have to scan the table.
+
+    >>> table.create_index('Style')
+    >>> table.filter(Style='Modernism') # looks up two rows
+
+A SortedIndex keeps a column's values in order, along with the
+position of the row each came from, so range filters, min, max
+and ordered iteration use binary search instead of a scan.
+
+    >>> table.create_index('Number of Pages', kind='sorted')
+    >>> table.filter(**{'Number of Pages__range': (100, 300)})
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class HashIndex(object):
+    """
+    Row positions for each distinct value in a column.
+    Positions for a value are kept in ascending order.
+    """
+    kind = 'hash'
+
+    def __init__(self, column_name, values=()):
+        self.column_name = column_name
+        self.build(values)
+
+    def __repr__(self):
+        return "<%s: %s, %s values>" % (self.__class__.__name__,
+            self.column_name, len(self))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, value):
+        return value in self.positions
+
+    def build(self, values):
+        "Index a column's values from scratch"
+        self.positions = positions = {}
+        for i, value in enumerate(values):
+            try:
+                positions[value].append(i)
+            except KeyError:
+                positions[value] = array('l', [i])
+
+    def add(self, value, position):
+        "Index a value added at the end of the table"
+        try:
+            self.positions[value].append(position)
+        except KeyError:
+            self.positions[value] = array('l', [position])
+
+    def lookup(self, value):
+        "Positions of rows holding value"
+        return self.positions.get(value, ())
+
+    def lookup_many(self, values):
+        "Positions of rows holding any of values, in order"
+        result = []
+        for value in set(values):
+            result.extend(self.lookup(value))
+        result.sort()
+        return result
+
+    def keys(self):
+        return self.positions.keys()
+
+    def items(self):
+        return self.positions.items()
+
+
+class SortedIndex(object):
+    """
+    A column's values in ascending order, with the position
+    of each value's row. Blank values (None) sort first.
+
+    Values are compared as they're given, so TableFu builds
+    sorted indexes from typed values where a column has a type,
+    and from floats (numeric) for untyped columns of numbers.
+    """
+    kind = 'sorted'
+    numeric = False
+
+    def __init__(self, column_name, values=(), typed=False, presorted=None):
+        self.column_name = column_name
+        self.typed = typed
+        self.build(values, presorted)
+
+    def __repr__(self):
+        return "<%s: %s, %s rows>" % (self.__class__.__name__,
+            self.column_name, len(self))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def build(self, values, presorted=None):
+        """
+        Index a column's values from scratch. If presorted is
+        False (ascending) or True (descending), the values are
+        checked and, if they're in order, used without sorting.
+        """
+        values = list(values)
+        n = len(values)
+        if presorted is not None:
+            ordered = presorted and values[::-1] or values
+            if all(ordered[i] <= ordered[i + 1] for i in xrange(n - 1)):
+                self.keys = ordered
+                if presorted:
+                    self.positions = array('l', xrange(n - 1, -1, -1))
+                else:
+                    self.positions = array('l', xrange(n))
+                return
+        order = sorted(xrange(n), key=values.__getitem__)
+        self.keys = [values[i] for i in order]
+        self.positions = array('l', order)
+
+    def add(self, value, position):
+        "Index a value added at the end of the table"
+        i = bisect_right(self.keys, value)
+        self.keys.insert(i, value)
+        self.positions.insert(i, position)
+
+    def _bounds(self, low=None, high=None, include_low=True, include_high=True):
+        if low is None:
+            # skip blanks, which sort first
+            start = bisect_right(self.keys, None)
+        elif include_low:
+            start = bisect_left(self.keys, low)
+        else:
+            start = bisect_right(self.keys, low)
+        if high is None:
+            end = len(self.keys)
+        elif include_high:
+            end = bisect_right(self.keys, high)
+        else:
+            end = bisect_left(self.keys, high)
+        return start, max(start, end)
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        """
+        Positions of rows with values between low and high,
+        in value order. Either end can be left open with None.
+        """
+        start, end = self._bounds(low, high, include_low, include_high)
+        return self.positions[start:end]
+
+    def lookup(self, value):
+        return self.range(value, value)
+
+    def _first(self):
+        "Where values start, after any blanks"
+        start = bisect_right(self.keys, None)
+        if not (self.typed or self.numeric):
+            start = bisect_right(self.keys, '', start)
+        if start == len(self.keys):
+            raise ValueError("%s has no values" % self.column_name)
+        return start
+
+    def min(self):
+        return self.keys[self._first()]
+
+    def max(self):
+        self._first()
+        return self.keys[-1]
+
+    def ordered(self, reverse=False):
+        "Row positions in value order"
+        if reverse:
+            return reversed(self.positions)
+        return iter(self.positions)
@@ -0,0 +1,364 @@
+"""
+Lazy query plans for TableFu tables.
+
+    >>> q = table.query().where(Style='Modernism').order_by('Author')
+    >>> q.select('Author', 'Best Book').limit(10).html()
+
+Building a query only records its steps. They run, in one pass
+over the table (or over a lazy table's file), the first time the
+query is iterated or exported. Before running, the plan is
+simplified:
+
+ - adjacent steps of the same kind are merged, and where steps
+   move ahead of any ordering, so each stretch of the plan up to
+   a limit filters rows once, as they're read, then orders them
+ - only the columns a query shows or uses are kept from each row
+   that passes the first filter
+ - an ordering followed by a limit picks rows with a heap, and a
+   limit on unordered rows stops reading once it has enough
+"""
+import csv
+import heapq
+from itertools import islice
+
+from table_fu.converters import is_blank
+from table_fu.query import compile_query, parse_lookup
+from table_fu.sorting import Reversed, sort_keys, sort_spec
+
+
+def _merge_where(first, second):
+    return first + second
+
+
+def _merge_order_by(first, second):
+    # sorting by first, then (stably) by second, is one sort by both
+    return second + first
+
+
+def _merge_limit(first, second):
+    return min(first, second)
+
+
+def _merge_select(first, second):
+    return second
+
+
+def _project(rows, positions):
+    "Keep the cells at positions from each (row_num, cells) pair"
+    for i, cells in rows:
+        yield i, [cells[j] for j in positions]
+
+
+MERGES = {
+    'where': _merge_where,
+    'order_by': _merge_order_by,
+    'limit': _merge_limit,
+    'select': _merge_select,
+}
+
+
+class Query(object):
+    """
+    A recorded plan of where, select, order_by and limit
+    steps over a table. Each step returns a new Query.
+
+    Iterating or exporting a query runs it once and keeps
+    the result, a new TableFu, as Query.result.
+    """
+    def __init__(self, table, steps=(), columns=None):
+        self.table = table
+        self.steps = tuple(steps)
+        if columns is None:
+            columns = list(table.default_columns)
+        self.columns = columns
+        self._result = None
+
+    def __repr__(self):
+        return "<Query: %s>" % ', '.join(
+            '%s(%r)' % (kind, arg) for kind, arg in self.steps)
+
+    def _add(self, kind, arg, columns=None):
+        steps = list(self.steps)
+        if steps and steps[-1][0] == kind:
+            steps[-1] = (kind, MERGES[kind](steps[-1][1], arg))
+        else:
+            steps.append((kind, arg))
+        return Query(self.table, steps, columns or self.columns)
+
+    def _check(self, column_name):
+        if column_name not in self.columns:
+            raise ValueError("%s isn't a column in this query" % column_name)
+
+    # building
+
+    def where(self, func=None, **query):
+        """
+        Keep rows matching filter-style keywords, or rows
+        for which func(row) is true
+        """
+        filters = []
+        if callable(func):
+            filters.append(func)
+        if query:
+            indexes = dict((c, i) for i, c in enumerate(self.columns))
+            for lookup in query:
+                parse_lookup(lookup, indexes)
+            filters.append(query)
+        return self._add('where', filters)
+
+    def select(self, *columns):
+        "Show only these columns, in this order"
+        for column_name in columns:
+            self._check(column_name)
+        return self._add('select', list(columns), list(columns))
+
+    def order_by(self, *keys, **kwargs):
+        """
+        Order rows by columns, given as names or (column, reverse)
+        pairs. Pass reverse=True to reverse every column by default.
+        """
+        keys = sort_keys(keys, kwargs.get('reverse', False))
+        for column_name, reverse in keys:
+            self._check(column_name)
+        return self._add('order_by', keys)
+
+    def limit(self, n):
+        "Keep only the first n rows"
+        return self._add('limit', int(n))
+
+    # planning
+
+    def plan(self):
+        """
+        The steps as they'll run: a list of (filters, keys, limit)
+        stretches, each filtering rows, then ordering them by keys,
+        then keeping the first limit rows
+        """
+        stretches = []
+        filters, keys = [], []
+        for kind, arg in self.steps:
+            if kind == 'where':
+                filters = filters + arg
+            elif kind == 'order_by':
+                keys = arg + keys
+            elif kind == 'limit':
+                stretches.append((filters, keys, arg))
+                filters, keys = [], []
+        if filters or keys or not stretches:
+            stretches.append((filters, keys, None))
+        return stretches
+
+    def _needed(self, stretches):
+        """
+        Columns to keep from each source row, in table order,
+        or None to keep whole rows
+        """
+        used = set(self.columns)
+        for filters, keys, limit in stretches:
+            for f in filters:
+                if callable(f):
+                    return None
+                used.update(parse_lookup(lookup, self.table.schema.indexes)[0]
+                    for lookup in f)
+            used.update(column_name for column_name, reverse in keys)
+        needed = [c for c in self.table.default_columns if c in used]
+        if len(needed) == len(self.table.default_columns):
+            return None
+        return needed
+
+    def _predicate(self, filters, layout):
+        """
+        One test of (cells, row_num) for a stretch's filters,
+        with keyword filters ahead of functions
+        """
+        table = self.table
+        conditions = compile_query(table,
+            [f for f in filters if not callable(f)]).conditions
+        for condition in conditions:
+            condition.index = layout[condition.column_name]
+        tests = list(conditions)
+        for f in filters:
+            if callable(f):
+                from table_fu import Row
+                tests.append(lambda cells, i, f=f: f(Row(cells, i, table)))
+        if not tests:
+            return None
+        if len(tests) == 1:
+            return tests[0]
+
+        def test(cells, i):
+            for t in tests:
+                if not t(cells, i):
+                    return False
+            return True
+        return test
+
+    def _getter(self, column_name, layout):
+        "A function of (cells, row_num) giving a column's sort key"
+        table = self.table
+        index = layout[column_name]
+        func = table.column_type(column_name)
+        if func is None:
+            return lambda cells, i: cells[index]
+        if not table.lazy:
+            typed = table.typed_values(column_name)
+            return lambda cells, i: typed[i]
+
+        def convert(cells, i):
+            value = cells[index]
+            if is_blank(value):
+                return None
+            try:
+                return func(value)
+            except (ValueError, TypeError):
+                raise ValueError('Column %s contains values that can\'t be converted' % column_name)
+        return convert
+
+    def _sort_key(self, keys, layout):
+        """
+        A key function for (row_num, cells) pairs that orders
+        them by keys, and whether to reverse the sort
+        """
+        getters = [(self._getter(c, layout), rev) for c, rev in keys]
+        reverse = getters[0][1]
+        if len(getters) == 1:
+            get = getters[0][0]
+            key = lambda (i, cells): get(cells, i)
+        elif all(rev == reverse for get, rev in getters):
+            key = lambda (i, cells): tuple([get(cells, i) for get, rev in getters])
+        else:
+            # keys that go against the first one compare the other way
+            key = lambda (i, cells): tuple([
+                Reversed(get(cells, i)) if rev != reverse else get(cells, i)
+                for get, rev in getters
+            ])
+        return key, reverse
+
+    def _rows(self):
+        "Run the plan, yielding the cells of each result row"
+        table = self.table
+        stretches = self.plan()
+        needed = self._needed(stretches)
+        layout = table.schema.indexes
+        projected = layout
+        if needed is not None:
+            projected = dict((c, n) for n, c in enumerate(needed))
+
+        # compile every step before reading any rows, since
+        # inferring a column's type reads in a lazy table
+        steps = []
+        for n, (filters, keys, limit) in enumerate(stretches):
+            predicate = self._predicate(filters, projected if n else layout)
+            sort_key = self._sort_key(keys, projected) if keys else None
+            steps.append((predicate, sort_key, limit))
+
+        rows = None
+        filters = [f for f in stretches[0][0] if not callable(f)]
+        if filters and not table.lazy:
+            # look candidate rows up in an index, as filter does
+            positions = table._indexed_positions(compile_query(table, filters))
+            if positions is not None:
+                source = table.table
+                rows = ((i, source[i]) for i in positions)
+        if rows is None:
+            rows = enumerate(table._iter_table())
+
+        for n, (predicate, sort_key, limit) in enumerate(steps):
+            if predicate is not None:
+                rows = ((i, cells) for i, cells in rows if predicate(cells, i))
+            if not n and needed is not None:
+                rows = _project(rows, [layout[c] for c in needed])
+            if sort_key is not None:
+                key, reverse = sort_key
+                if limit is None:
+                    rows = sorted(rows, key=key, reverse=reverse)
+                else:
+                    select = reverse and heapq.nlargest or heapq.nsmallest
+                    rows = select(limit, rows, key=key)
+            elif limit is not None:
+                rows = islice(rows, limit)
+
+        if self.columns != table.default_columns:
+            rows = _project(rows, [projected[c] for c in self.columns])
+            return (cells for i, cells in rows)
+        return (list(cells) for i, cells in rows)
+
+    def _options(self):
+        "Options for the result, dropping any that no longer apply"
+        options = self.table.options.copy()
+        if self.columns != self.table.default_columns:
+            options.pop('columns', None)
+        spec = options.pop('sorted_by', None)
+        for filters, keys, limit in self.plan():
+            if keys:
+                spec = sort_spec(keys)
+        if all(c in self.columns for c, rev in sort_keys(spec)):
+            if spec:
+                options['sorted_by'] = spec
+        return options
+
+    # running
+
+    def execute(self):
+        "Run this query, once, returning a new TableFu"
+        if self._result is None:
+            rows = list(self._rows())
+            rows.insert(0, list(self.columns))
+            self._result = self.table.__class__(rows, **self._options())
+        return self._result
+
+    result = property(execute)
+
+    def __iter__(self):
+        return iter(self.execute())
+
+    def __len__(self):
+        return len(self.execute())
+
+    def __getitem__(self, row_num):
+        return self.execute()[row_num]
+
+    def count(self):
+        return len(self)
+
+    @property
+    def rows(self):
+        return self.execute().rows
+
+    def values(self, column_name, unique=False):
+        return self.execute().values(column_name, unique)
+
+    def html(self):
+        return self.execute().html()
+
+    def csv(self, **kwargs):
+        return self.execute().csv(**kwargs)
+
+    def write_csv(self, fp, formatted=False, chunk_rows=1000, **kwargs):
+        """
+        Write the query's rows as a CSV. Unformatted rows are
+        written as the plan yields them, without building a table.
+        """
+        if formatted or self._result is not None:
+            return self.execute().write_csv(fp, formatted, chunk_rows, **kwargs)
+        from table_fu import _project_rows, _write_chunks
+        kwargs.pop('encoding', None)
+        rows = self._rows()
+        columns = self.columns
+        if columns == self.table.default_columns:
+            # without a select, the result shows the table's columns
+            columns = self.table.columns
+            if columns != self.columns:
+                rows = _project_rows(rows, [self.columns.index(c) for c in columns])
+        writer = csv.writer(fp, **kwargs)
+        writer.writerow(columns)
+        _write_chunks(writer, rows, chunk_rows)
+
+    def write_html(self, fp, chunk_rows=1000, encoding='utf-8'):
+        return self.execute().write_html(fp, chunk_rows, encoding)
+
+    def dict(self):
+        return self.execute().dict()
+
+    def json(self, **kwargs):
+        return self.execute().json(**kwargs)
@@ -0,0 +1,198 @@
+"""
+Compiling TableFu.filter keyword queries.
+
+Keywords look like Django lookups: a column name, optionally
+followed by two underscores and an operator.
+
+    >>> table.filter(Style='Modernism')
+    >>> table.filter(**{'Number of Pages__gt': 200})
+    >>> table.filter(Style__in=['Modernism', 'Satire'], Author__startswith='S')
+
+Every condition is compiled into one predicate that works on a
+row's raw cells, so a table is filtered in a single pass.
+
+Values that aren't strings are compared with converted cells:
+typed columns use their converter, and other columns are read
+as floats (or dates, for date values). Cells that can't be
+converted never match.
+"""
+from datetime import date
+from decimal import Decimal
+
+from table_fu.converters import is_blank, parse_date
+
+OPERATORS = (
+    'exact', 'iexact', 'contains', 'icontains', 'startswith', 'endswith',
+    'in', 'gt', 'gte', 'lt', 'lte', 'range', 'isnull',
+)
+# operators that compare converted values when given a non-string
+COMPARISONS = ('exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range')
+NUMBERS = (int, long, float, Decimal)
+
+
+def parse_lookup(lookup, indexes):
+    """
+    Splits a keyword into (column_name, operator). Column
+    names that contain '__' are matched whole first.
+    """
+    if lookup in indexes:
+        return lookup, 'exact'
+    if '__' in lookup:
+        column_name, op = lookup.rsplit('__', 1)
+        if op in OPERATORS and column_name in indexes:
+            return column_name, op
+    raise KeyError("%s isn't a column in this table" % lookup)
+
+
+def _text(cell):
+    if isinstance(cell, basestring):
+        return cell
+    return str(cell)
+
+
+def _fallback_converter(value):
+    "How to read untyped cells to compare with value"
+    if isinstance(value, date):
+        return parse_date
+    if isinstance(value, NUMBERS) and not isinstance(value, bool):
+        return float
+    return None
+
+
+class Condition(object):
+    """
+    One column lookup, like Pages__gt=100, compiled
+    into a test on a row's cells
+    """
+    def __init__(self, table, lookup, value):
+        self.column_name, self.op = parse_lookup(lookup, table.schema.indexes)
+        self.index = table.schema.indexes[self.column_name]
+        self.value = value
+        self.typed = None
+        self.convert = None
+
+        compared = value
+        if self.op in ('in', 'range'):
+            compared = None
+            for v in value:
+                if not isinstance(v, basestring):
+                    compared = v
+                    break
+        if self.op in COMPARISONS and compared is not None \
+            and not isinstance(compared, basestring):
+            func = table.column_type(self.column_name)
+            if func is None:
+                self.convert = _fallback_converter(compared)
+            elif table.lazy:
+                # don't read all of a lazy table to fill the cache
+                self.convert = func
+            else:
+                self.typed = table.typed_values(self.column_name)
+
+        self.test = getattr(self, '_' + self.op)()
+
+    def __repr__(self):
+        return "<Condition: %s__%s=%r>" % (self.column_name, self.op, self.value)
+
+    def __call__(self, cells, row_num):
+        if self.typed is not None:
+            cell = self.typed[row_num]
+        else:
+            cell = cells[self.index]
+            if self.convert is not None:
+                if is_blank(cell):
+                    return False
+                try:
+                    cell = self.convert(cell)
+                except (ValueError, TypeError, ArithmeticError):
+                    return False
+        return self.test(cell)
+
+    # each of these returns a test for one (possibly converted) cell
+
+    def _exact(self):
+        value = self.value
+        return lambda cell: cell == value
+
+    def _iexact(self):
+        value = self.value.lower()
+        return lambda cell: _text(cell).lower() == value
+
+    def _contains(self):
+        value = self.value
+        return lambda cell: value in _text(cell)
+
+    def _icontains(self):
+        value = self.value.lower()
+        return lambda cell: value in _text(cell).lower()
+
+    def _startswith(self):
+        value = self.value
+        return lambda cell: _text(cell).startswith(value)
+
+    def _endswith(self):
+        value = self.value
+        return lambda cell: _text(cell).endswith(value)
+
+    def _in(self):
+        try:
+            values = frozenset(self.value)
+        except TypeError:
+            values = list(self.value)
+        return lambda cell: cell in values
+
+    def _gt(self):
+        value = self.value
+        return lambda cell: cell is not None and cell > value
+
+    def _gte(self):
+        value = self.value
+        return lambda cell: cell is not None and cell >= value
+
+    def _lt(self):
+        value = self.value
+        return lambda cell: cell is not None and cell < value
+
+    def _lte(self):
+        value = self.value
+        return lambda cell: cell is not None and cell <= value
+
+    def _range(self):
+        low, high = self.value
+        return lambda cell: cell is not None and low <= cell <= high
+
+    def _isnull(self):
+        value = bool(self.value)
+        return lambda cell: is_blank(cell) == value
+
+
+class Predicate(object):
+    """
+    A compiled keyword query. Calling it with a row's cells
+    and position returns True if every condition matches.
+
+    The query can also be a list of keyword dicts, which
+    must all match.
+    """
+    def __init__(self, table, query):
+        if isinstance(query, dict):
+            query = [query]
+        self.conditions = [
+            Condition(table, lookup, value)
+            for q in query
+            for lookup, value in sorted(q.items())
+        ]
+
+    def __repr__(self):
+        return "<Predicate: %s>" % ', '.join(repr(c) for c in self.conditions)
+
+    def __call__(self, cells, row_num):
+        for condition in self.conditions:
+            if not condition(cells, row_num):
+                return False
+        return True
+
+
+def compile_query(table, query):
+    "Compile filter keywords for a table into a Predicate"
+    return Predicate(table, query)
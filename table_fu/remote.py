@@ -0,0 +1,141 @@
+"""
+Loading tables from many URLs at once.
+
+Each worker thread keeps one open HTTP connection per host,
+so a batch of spreadsheets from the same server reuses a
+handful of connections. Responses are read in blocks and
+handed to the csv parser line by line as they arrive.
+"""
+import httplib
+import socket
+import threading
+import urlparse
+from Queue import Empty, Queue
+
+REDIRECTS = (301, 302, 303, 307)
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool(object):
+    """
+    Open HTTP connections, one for each scheme and host.
+
+    Connections stay open between requests. A pool isn't
+    thread-safe, so each worker should keep its own.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.connections = {}
+
+    def _connect(self, scheme, host):
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        if self.timeout is None:
+            conn = cls(host)
+        else:
+            conn = cls(host, timeout=self.timeout)
+        self.connections[(scheme, host)] = conn
+        return conn
+
+    def _request(self, scheme, host, path):
+        conn = self.connections.get((scheme, host))
+        if conn is None:
+            conn = self._connect(scheme, host)
+        try:
+            conn.request('GET', path)
+            return conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # the server may have closed an idle connection
+            conn.close()
+            conn = self._connect(scheme, host)
+            conn.request('GET', path)
+            return conn.getresponse()
+
+    def open(self, url):
+        """
+        Request a URL, following redirects, and return the
+        response. Raises IOError for anything but a 200.
+        """
+        for i in xrange(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            resp = self._request(parts.scheme, parts.netloc, path)
+            if resp.status in REDIRECTS and resp.getheader('location'):
+                resp.read()
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                continue
+            if resp.status != 200:
+                resp.read()
+                raise IOError("%s returned HTTP %s" % (url, resp.status))
+            return resp
+        raise IOError("Too many redirects from %s" % url)
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+
+def iter_lines(resp, blocksize=1 << 16):
+    """
+    Yield lines from a response as blocks arrive,
+    keeping line endings for the csv module
+    """
+    pending = ''
+    while True:
+        block = resp.read(blocksize)
+        if not block:
+            break
+        lines = (pending + block).splitlines(True)
+        pending = lines.pop()
+        if pending.endswith('\n'):
+            lines.append(pending)
+            pending = ''
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def load_all(urls, load, concurrency=4, timeout=None):
+    """
+    Call load(lines) for each URL's response, with at most
+    `concurrency` requests in flight. Returns the results in
+    the same order as urls, or raises the first error.
+    """
+    urls = list(urls)
+    results = [None] * len(urls)
+    errors = []
+    queue = Queue()
+    for item in enumerate(urls):
+        queue.put(item)
+
+    def work():
+        pool = ConnectionPool(timeout)
+        try:
+            while not errors:
+                try:
+                    i, url = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[i] = load(iter_lines(pool.open(url)))
+                except Exception, e:
+                    errors.append(e)
+        finally:
+            pool.close()
+
+    threads = [threading.Thread(target=work) for i in xrange(min(concurrency, len(urls)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,59 @@
+"""
+Sort specs for TableFu.sort, top and query ordering.
+
+A spec names the columns to sort on, in order, and which way
+each one goes. It can be a column name, a dict like
+options['sorted_by'] or a list of either, with (column, reverse)
+pairs for columns that sort their own way:
+
+    >>> sort_keys(['Style', ('Number of Pages', True)])
+    [('Style', False), ('Number of Pages', True)]
+"""
+
+
+def sort_keys(spec, reverse=False):
+    """
+    Turns a sort spec into a list of (column_name, reverse).
+    A spec is a column name, a {column: {'reverse': bool}}
+    dict like options['sorted_by'], or a list of column names,
+    (column, reverse) pairs or those dicts.
+    """
+    if not spec:
+        return []
+    if isinstance(spec, basestring):
+        return [(spec, reverse)]
+    if isinstance(spec, dict):
+        return [(name, opts.get('reverse', reverse))
+            for name, opts in sorted(spec.items())]
+    keys = []
+    for key in spec:
+        if isinstance(key, (tuple, list)):
+            name, rev = key
+            if isinstance(rev, dict):
+                rev = rev.get('reverse', reverse)
+            keys.append((name, bool(rev)))
+        else:
+            keys.extend(sort_keys(key, reverse))
+    return keys
+
+
+def sort_spec(keys):
+    """
+    How a sort is recorded in options['sorted_by']: a dict for
+    one column, or a list of one-column dicts, in order
+    """
+    spec = [{name: {'reverse': rev}} for name, rev in keys]
+    if len(spec) == 1:
+        return spec[0]
+    return spec
+
+
+class Reversed(object):
+    "Wraps a sort key so it compares the other way"
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
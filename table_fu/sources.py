@@ -0,0 +1,303 @@
+"""
+Sources that read rows out of a CSV file on demand.
+
+A MappedTable maps a file into memory and keeps only the
+byte offset where each record starts. Rows are parsed when
+they're asked for, so a table of any size can be opened
+quickly and paged through without reading it all.
+
+parse_parallel splits a file into chunks and parses them
+in a pool of processes. Each chunk comes back as a few long
+strings, its dumped columns, so the parent process only has
+to split them and build rows, not unpickle every cell.
+
+A RowView reads a subset of another table's rows, by position,
+without copying them. Facets are built from views.
+
+Finding where records start means watching for quoted
+newlines: a line ends a record only if it leaves an even
+number of quote characters behind it.
+"""
+from __future__ import with_statement
+
+import csv
+import marshal
+import mmap
+import os
+from array import array
+from itertools import izip
+
+from table_fu.columnar import (ColumnarTable, columns_to_rows, dump_columns,
+    infer_column, join_columns, load_columns, paused_gc)
+
+
+def get_quotechar(dialect='excel'):
+    "Returns the quote character for a csv dialect or dialect name"
+    if isinstance(dialect, basestring):
+        dialect = csv.get_dialect(dialect)
+    return dialect.quotechar or '"'
+
+
+def record_offsets(lines, start=0, quotechar='"'):
+    """
+    Yields the byte offset of each record in an iterable
+    of lines, starting at offset start, followed by the
+    offset just past the last line.
+    """
+    position = start
+    open_quotes = False
+    for line in lines:
+        if not open_quotes:
+            yield position
+        if line.count(quotechar) % 2:
+            open_quotes = not open_quotes
+        position += len(line)
+    yield position
+
+
+class MappedTable(object):
+    """
+    A read-only list of rows backed by a memory-mapped file.
+
+    The first record is read as the header. Everything
+    after it is indexed, but not parsed, when the table
+    is opened.
+    """
+    readonly = True
+
+    def __init__(self, path, dialect='excel'):
+        self.path = path
+        self.dialect = dialect
+        self._file = open(path, 'rb')
+        self.offsets = array('l')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._map = ''
+            self.header = []
+            return
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        lines = iter(self._map.readline, '')
+        self.offsets.extend(record_offsets(lines, quotechar=get_quotechar(dialect)))
+        if len(self.offsets) > 1:
+            self.header = self._parse(0)
+            self.offsets.pop(0)
+        else:
+            self.header = []
+
+    def _parse(self, i):
+        text = self._map[self.offsets[i]:self.offsets[i + 1]]
+        for row in csv.reader(text.splitlines(True), dialect=self.dialect):
+            return row
+        return []
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._parse(i) for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self._parse(index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._parse(i)
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s: %s, %s rows>" % (self.__class__.__name__, self.path, len(self))
+
+    def close(self):
+        "Unmap and close the underlying file"
+        if hasattr(self._map, 'close'):
+            self._map.close()
+        self._file.close()
+
+
+class RowView(object):
+    """
+    A read-only list of some of another table's rows,
+    given as an array of positions in that table.
+
+    Rows are read from the parent table when they're used.
+    Given the table that owns the rows, a view checks that
+    table's version, and raises ValueError once it changes,
+    rather than reading rows that have moved.
+    """
+    readonly = True
+
+    def __init__(self, rows, positions, header=None, owner=None):
+        self.rows = rows
+        self.positions = array('l', positions)
+        self.header = header
+        self.owner = owner
+        self.version = owner is not None and owner.version or 0
+
+    def _check(self):
+        if self.owner is not None and self.owner.version != self.version:
+            raise ValueError("The table this view reads from has changed")
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        self._check()
+        if isinstance(index, slice):
+            return [self.rows[i] for i in self.positions[index]]
+        return self.rows[self.positions[index]]
+
+    def __iter__(self):
+        self._check()
+        rows = self.rows
+        for i in self.positions:
+            yield rows[i]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def split_records(path, parts, quotechar='"', blocksize=1 << 20):
+    """
+    Returns byte offsets that split a file into about `parts`
+    chunks, each starting at the beginning of a record. The
+    first offset is 0 and the last is the size of the file.
+
+    Quote characters are counted a block at a time, so the
+    file is read once without being parsed.
+    """
+    size = os.path.getsize(path)
+    targets = [size * i // parts for i in xrange(1, parts)]
+    boundaries = [0]
+    quotes = 0
+    position = 0
+    searching = False
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            i = 0
+            while i < len(block):
+                if searching:
+                    # look for a newline outside of quotes
+                    newline = block.find('\n', i)
+                    if newline == -1:
+                        quotes += block.count(quotechar, i)
+                        break
+                    quotes += block.count(quotechar, i, newline)
+                    i = newline + 1
+                    if quotes % 2 == 0:
+                        boundary = position + i
+                        if boundary < size:
+                            boundaries.append(boundary)
+                        targets = [t for t in targets if t >= boundary]
+                        searching = False
+                elif targets and targets[0] - position < len(block):
+                    target = max(targets[0] - position, i)
+                    quotes += block.count(quotechar, i, target)
+                    i = target
+                    searching = True
+                else:
+                    quotes += block.count(quotechar, i)
+                    break
+            position += len(block)
+    boundaries.append(size)
+    return boundaries
+
+
+def cpu_count():
+    "The number of CPUs, or 1 if it can't be found"
+    try:
+        from multiprocessing import cpu_count
+        return cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def _parse_chunk(args):
+    """
+    Parse the records between two byte offsets in a file. Returns
+    the header (from the first chunk), the number of rows, and
+    either their dumped columns or, if rows differ in length,
+    the rows themselves, marshaled.
+    """
+    path, start, end, dialect, first, packed = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    with paused_gc():
+        rows = list(csv.reader(data.splitlines(True), dialect=dialect))
+    header = None
+    if first and rows:
+        header = rows.pop(0)
+    widths = set(map(len, rows))
+    if len(widths) > 1:
+        return header, len(rows), None, marshal.dumps(rows)
+    columns = [list(column) for column in izip(*rows)]
+    if packed:
+        columns = [infer_column(column) for column in columns]
+    return header, len(rows), dump_columns(columns), None
+
+
+def parse_parallel(path, workers, dialect='excel', columnar=False):
+    """
+    Parses a CSV file in `workers` processes, returning every
+    row (including the header) in file order, or with
+    columnar=True, a ColumnarTable with a header.
+    Needs multiprocessing, from Python 2.6.
+    """
+    from multiprocessing import Pool
+
+    boundaries = split_records(path, workers, get_quotechar(dialect))
+    tasks = [
+        (path, start, end, dialect, start == 0, columnar)
+        for start, end in zip(boundaries, boundaries[1:])
+        if end > start
+    ]
+    pool = Pool(workers)
+    try:
+        chunks = pool.map(_parse_chunk, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    header = chunks and chunks[0][0] or []
+    chunks = [chunk for chunk in chunks if chunk[1]]
+    parts = [load_columns(dumped, n) for h, n, dumped, rows in chunks if dumped is not None]
+    if len(parts) == len(chunks) and len(set(map(len, parts))) <= 1:
+        columns = join_columns(parts)
+        if columnar:
+            return ColumnarTable.from_columns(columns, header)
+        rows = columns_to_rows(columns)
+    else:
+        # rows of different lengths can't be put back together from columns
+        rows = []
+        for h, n, dumped, dumped_rows in chunks:
+            if dumped is None:
+                rows.extend(marshal.loads(dumped_rows))
+            else:
+                rows.extend(columns_to_rows(load_columns(dumped, n)))
+        if columnar:
+            return ColumnarTable.from_columns(ColumnarTable(rows).columns, header)
+    rows.insert(0, header)
+    return rows
@@ -1,9 +1,12 @@
 #! /usr/bin/env python
 import csv
+import os
 import unittest
 import urllib2
-from table_fu import TableFu
-from table_fu.formatting import Formatter
+from table_fu import TableFu, has_numpy
+from table_fu.aggregates import Mean, count
+from table_fu.formatting import Formatter, capfirst
+from table_fu.query import compile_query
 
 
 class TableTest(unittest.TestCase):
@@ -42,6 +45,301 @@ class BigTableTest(TableTest):
         self.assertEqual(t1.table, t2.table)
 
 
+class LazyTest(TableTest):
+
+    def test_lazy_rows(self):
+        "A lazy table streams the same rows as an eager one"
+        t = TableFu(self.csv_file, lazy=True)
+        self.assertTrue(t.lazy)
+        self.table.pop(0)
+        self.assertEqual([row.cells for row in t.rows], self.table)
+
+    def test_lazy_columns(self):
+        "Columns are read before any rows"
+        t = TableFu(self.csv_file, lazy=True)
+        self.assertEqual(t.columns, self.table[0])
+        self.assertTrue(t.lazy)
+
+    def test_lazy_values(self):
+        "Values stream from the source"
+        t = TableFu(self.csv_file, lazy=True)
+        self.table.pop(0)
+        self.assertEqual(t.values('Author'), [row[0] for row in self.table])
+
+    def test_lazy_sort(self):
+        "Sorting reads in the rest of the table"
+        t = TableFu(self.csv_file, lazy=True)
+        t.sort('Author')
+        self.assertFalse(t.lazy)
+        self.table.pop(0)
+        self.table.sort(key=lambda row: row[0])
+        self.assertEqual(t.table, self.table)
+
+    def test_lazy_count(self):
+        "Counting or listing a lazy table streams every row"
+        self.assertEqual(TableFu.stream('tests/test.csv').count(), 5)
+        t = TableFu.stream('tests/test.csv')
+        self.assertEqual(len(list(t)), 5)
+        self.assertFalse(t.lazy)
+        self.assertRaises(TypeError, len, t)
+
+    def test_lazy_map(self):
+        "Mapping over columns streams them, without reading in the table"
+        t = TableFu(self.csv_file, lazy=True)
+        self.table.pop(0)
+        self.assertEqual(t.map(str.lower, 'Style'), [row[3].lower() for row in self.table])
+        self.assertFalse(t.lazy)
+        self.assertRaises(ValueError, lambda: t.table)
+        t = TableFu.stream('tests/test.csv')
+        self.assertEqual(t.map(len, 'Author', 'Style'), [
+            [len(row[0]) for row in self.table],
+            [len(row[3]) for row in self.table],
+        ])
+
+    def test_lazy_read_once(self):
+        "Reading a lazy table's rows again raises, rather than coming back empty"
+        t = TableFu.stream('tests/test.csv')
+        self.assertTrue('Samuel Beckett' in t.html())
+        self.assertRaises(ValueError, t.csv)
+        self.assertRaises(ValueError, t.count)
+        self.assertRaises(ValueError, lambda: t.table)
+
+    def test_stream(self):
+        "TableFu.stream opens a path lazily"
+        t = TableFu.stream('tests/test.csv')
+        self.assertTrue(t.lazy)
+        self.assertEqual(
+            t.filter(Style='Modernism').values('Author'),
+            ['Samuel Beckett', 'James Joyce']
+        )
+
+
+class MappedTest(TableTest):
+
+    def test_mapped_table(self):
+        "A memory-mapped table reads the same rows"
+        t = TableFu.from_file('tests/test.csv', mmap=True)
+        self.assertEqual(t.columns, self.table[0])
+        self.assertEqual(t.table, self.table[1:])
+        self.assertEqual(len(t), 5)
+
+    def test_mapped_offsets(self):
+        "Rows are indexed by where they start in the file"
+        t = TableFu.from_file('tests/test.csv', mmap=True)
+        self.assertEqual(len(t.table.offsets), 6)
+        self.assertEqual(t[3].cells, self.table[4])
+        self.assertEqual(t[-1].cells, self.table[5])
+
+    def test_mapped_slice(self):
+        "Slicing parses only the rows in the slice"
+        t = TableFu.from_file('tests/test.csv', mmap=True)
+        page = t[1:3]
+        self.assertEqual([row.cells for row in page], self.table[2:4])
+        self.assertEqual([row.row_num for row in page], [1, 2])
+
+    def test_mapped_quoted_newlines(self):
+        "Quoted newlines don't start a new row"
+        import tempfile, os
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        f = os.fdopen(fd, 'w')
+        f.write('Name,About\r\nOne,"first\r\nline"\r\nTwo,second\r\n')
+        f.close()
+        try:
+            t = TableFu.from_file(path, mmap=True)
+            self.assertEqual(len(t), 2)
+            self.assertEqual(t[0]['About'].value, 'first\r\nline')
+            self.assertEqual(t[1]['Name'].value, 'Two')
+            t.table.close()
+        finally:
+            os.remove(path)
+
+    def test_mapped_sort(self):
+        "Changing a mapped table copies it into memory"
+        t = TableFu.from_file('tests/test.csv', mmap=True)
+        t.sort('Author')
+        self.assertEqual(type(t.table), list)
+        self.assertEqual(t[0]['Author'], 'Ayn Rand')
+
+
+class ParallelTest(TableTest):
+
+    def test_split_records(self):
+        "Chunks start at records, even with quoted newlines"
+        from table_fu.sources import split_records
+        import tempfile, os
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        f = os.fdopen(fd, 'w')
+        f.write('Name,About\n' + 'One,"first\nline"\nTwo,second\n' * 20)
+        f.close()
+        try:
+            boundaries = split_records(path, 8, blocksize=5)
+            data = open(path, 'rb').read()
+            chunks = [data[a:b] for a, b in zip(boundaries, boundaries[1:])]
+            self.assertEqual(''.join(chunks), data)
+            rows = []
+            for chunk in chunks:
+                rows.extend(csv.reader(chunk.splitlines(True)))
+            self.assertEqual(rows, list(csv.reader(open(path))))
+        finally:
+            os.remove(path)
+
+    def test_parallel_from_file(self):
+        "Parsing in several processes gives the same table"
+        t1 = TableFu.from_file('tests/arra.csv', workers=3)
+        t2 = TableFu.from_file('tests/arra.csv')
+        self.assertEqual(t1.columns, t2.columns)
+        self.assertEqual(t1.table, t2.table)
+
+    def test_parse_parallel(self):
+        "Chunks come back as packed columns, even on one CPU"
+        from table_fu.sources import parse_parallel
+        rows = list(csv.reader(open('tests/arra.csv')))
+        self.assertEqual(parse_parallel('tests/arra.csv', 3), rows)
+        table = parse_parallel('tests/arra.csv', 3, columnar=True)
+        self.assertEqual(table.header, rows[0])
+        t = TableFu.from_file('tests/arra.csv', columnar=True)
+        self.assertEqual(table.typecodes, t.table.typecodes)
+        self.assertEqual(list(table), list(t.table))
+        self.assertEqual(TableFu(table).columns, rows[0])
+
+    def test_parse_parallel_ragged(self):
+        "Rows of different lengths are kept as they are"
+        from table_fu.sources import parse_parallel
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, 'a,b\n' + '1,2\n3\n4,5,6\n' * 50)
+        os.close(fd)
+        try:
+            self.assertEqual(parse_parallel(path, 4), list(csv.reader(open(path))))
+        finally:
+            os.remove(path)
+
+
+class CacheTest(TableTest):
+
+    def setUp(self):
+        import tempfile
+        TableTest.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        TableTest.tearDown(self)
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_roundtrip(self):
+        "A cached table is the same as a parsed one"
+        t1 = TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir)
+        t2 = TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir)
+        self.assertEqual(t1.table, t2.table)
+        self.assertEqual(t2.columns, self.table[0])
+        self.assertEqual(t2.table, self.table[1:])
+
+    def test_cache_columns(self):
+        "Cached tables load column by column, as strings or packed"
+        from table_fu.columnar import ColumnarTable
+        TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir)
+        t = TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir)
+        self.assertTrue(isinstance(t.table, ColumnarTable))
+        self.assertEqual(t.table.typecodes, [None] * 4)
+        self.assertEqual(t.values('Number of Pages'), ['120', '644', '150', '263', '1088'])
+        t.sort('Author')
+        self.assertEqual(t[0]['Author'], 'Ayn Rand')
+
+        t = TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir, columnar=True)
+        control = TableFu.from_file('tests/test.csv', columnar=True)
+        self.assertEqual(t.table.typecodes, control.table.typecodes)
+        self.assertEqual(t.table, control.table)
+        self.assertEqual(t.total('Number of Pages'), 2265.0)
+
+    def test_cache_hit(self):
+        "A second load comes from the cache"
+        from table_fu.cache import TableCache
+        cache = TableCache(self.cache_dir)
+        TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir)
+        self.assertEqual(len(cache.entries()), 1)
+        entry = cache.get(cache.key('tests/test.csv'))
+        self.assertEqual(entry[0], self.table[0])
+        self.assertEqual(entry[1], self.table[1:])
+
+    def test_cache_types(self):
+        "Inferred types are cached with the table"
+        TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir, infer_types=True)
+        t = TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir, infer_types=True)
+        self.assertEqual(t._inferred[2], int)
+        self.assertEqual(t.total('Number of Pages'), 2265.0)
+
+        t = TableFu.from_file('tests/test.csv', cache_dir=self.cache_dir)
+        self.assertEqual(t._inferred, {})
+        self.assertEqual(t.column_type('Number of Pages'), None)
+
+    def test_cache_dialect(self):
+        "Files parsed with different dialects are cached apart"
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv', dir=self.cache_dir)
+        os.write(fd, 'a;b\r\n1;2\r\n')
+        os.close(fd)
+        csv.register_dialect('semi', delimiter=';')
+        try:
+            t = TableFu.from_file(path, cache_dir=self.cache_dir)
+            self.assertEqual(t.columns, ['a;b'])
+            t = TableFu.from_file(path, cache_dir=self.cache_dir, dialect='semi')
+            self.assertEqual(t.columns, ['a', 'b'])
+            self.assertEqual(t.table, [['1', '2']])
+        finally:
+            csv.unregister_dialect('semi')
+
+    def test_cache_eviction(self):
+        "The oldest entries are removed when the cache is too big"
+        from table_fu.cache import TableCache
+        cache = TableCache(self.cache_dir, max_size=2000)
+        cache.put('old', ['a'], [['x' * 1000]])
+        import os, time
+        old = os.path.join(self.cache_dir, 'old.tablefu')
+        os.utime(old, (time.time() - 100, time.time() - 100))
+        cache.put('new', ['a'], [['y' * 1000]])
+        self.assertEqual(cache.get('old'), None)
+        self.assertEqual(cache.get('new'), (['a'], [['y' * 1000]], {}))
+
+
+class ColumnarTest(TableTest):
+
+    def test_columnar_types(self):
+        "Numeric columns are packed into typed arrays"
+        t = TableFu(self.csv_file, columnar=True)
+        self.assertEqual(t.table.typecodes, [None, None, 'l', None])
+        self.assertEqual(t.values('Number of Pages'), [120, 644, 150, 263, 1088])
+
+    def test_columnar_rows(self):
+        "Rows and data read the same as a row-based table"
+        t = TableFu(self.csv_file, columnar=True)
+        self.assertEqual(t[0].cells, ['Samuel Beckett', 'Malone Muert', 120, 'Modernism'])
+        self.assertEqual(str(t[0]['Number of Pages']), '120')
+        self.assertEqual(len(t), 5)
+
+    def test_columnar_total(self):
+        "Totals come straight from the array"
+        t = TableFu(self.csv_file, columnar=True)
+        self.assertEqual(t.total('Number of Pages'), 2265.0)
+
+    def test_columnar_lossless(self):
+        "Values that don't survive conversion stay strings"
+        t = TableFu([['FIPS', 'Rate'], ['01', '1.50'], ['02', '2.25']], columnar=True)
+        self.assertEqual(t.table.typecodes, [None, None])
+        self.assertEqual(t.values('FIPS'), ['01', '02'])
+
+    def test_columnar_sort_and_transform(self):
+        "Columnar tables sort and transform in place"
+        t = TableFu(self.csv_file, columnar=True)
+        t.sort('Number of Pages')
+        self.assertEqual(t.values('Number of Pages'), [120, 150, 263, 644, 1088])
+        t.transform('Number of Pages', lambda v: v * 2)
+        self.assertEqual(t.total('Number of Pages'), 4530.0)
+        t.add_rows(['Someone', 'Something', '100', 'Beat'])
+        self.assertEqual(t.table.typecodes[2], 'l')
+        self.assertEqual(t[-1]['Number of Pages'].value, 100)
+
+
 class ColumnTest(TableTest):
 
     def test_get_columns(self):
@@ -57,6 +355,30 @@ class ColumnTest(TableTest):
         self.assertEqual(t.columns, columns)
 
 
+class SchemaTest(TableTest):
+
+    def test_schema_indexes(self):
+        "A table's schema maps column names to positions"
+        t = TableFu(self.csv_file)
+        self.assertEqual(t.schema.indexes['Style'], 3)
+        self.assertEqual(t.schema.positions, [0, 1, 2, 3])
+
+    def test_schema_columns(self):
+        "Setting columns rebuilds the schema"
+        t = TableFu(self.csv_file)
+        schema = t.schema
+        t.columns = ['Style', 'Author']
+        self.assertNotEqual(schema, t.schema)
+        self.assertEqual(t.schema.positions, [3, 0])
+        self.assertEqual(t[0].values(), ['Modernism', 'Samuel Beckett'])
+
+    def test_schema_missing_column(self):
+        "Showing a column that isn't in the table raises KeyError"
+        t = TableFu(self.csv_file)
+        t.columns = ['Author', 'Publisher']
+        self.assertRaises(KeyError, t[0].values)
+
+
 class HeaderTest(TableTest):
     
     def test_get_headers(self):
@@ -90,6 +412,32 @@ class RowTest(TableTest):
             )
 
 
+class FlyweightTest(TableTest):
+
+    def test_slots(self):
+        "Rows, data and headers don't carry a __dict__"
+        t = TableFu(self.csv_file)
+        for obj in (t[0], t[0]['Author'], t.headers[0]):
+            self.assertFalse(hasattr(obj, '__dict__'))
+
+    def test_copy_on_write(self):
+        "Setting a cell on a row doesn't change the table"
+        t = TableFu(self.csv_file)
+        row = t[0]
+        self.assertTrue(row.cells is t.table[0])
+        row['Author'] = 'Someone new'
+        self.assertEqual(t.table[0][0], 'Samuel Beckett')
+        self.assertEqual(row['Author'], 'Someone new')
+
+    def test_flyweight_rows(self):
+        "Flyweight iteration reuses one row"
+        t = TableFu(self.csv_file)
+        rows = list(t.iter_rows(flyweight=True))
+        self.assertTrue(rows[0] is rows[-1])
+        values = [row['Author'].value for row in t.iter_rows(flyweight=True)]
+        self.assertEqual(values, t.values('Author'))
+
+
 class RowColumnTest(TableTest):
      
     def test_limit_columns(self):
@@ -213,6 +561,112 @@ class SortTest(TableTest):
             self.table[0]
         )
 
+    def test_sort_again(self):
+        "Sorting with no column reuses the last column, in the new direction"
+        t = TableFu(self.csv_file)
+        t.sort('Author')
+        t.sort(reverse=True)
+        self.assertEqual(t[0]['Author'], 'Vladimir Sorokin')
+        self.assertEqual(t.options['sorted_by'], {'Author': {'reverse': True}})
+        t.sort()
+        self.assertEqual(t[0]['Author'], 'Ayn Rand')
+
+    def test_multi_sort(self):
+        "Sort on several columns, each in its own direction"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        t.sort(['Style', ('Number of Pages', True)])
+        self.assertEqual(t.values('Author'), ['Nicholson Baker', 'James Joyce',
+            'Samuel Beckett', 'Vladimir Sorokin', 'Ayn Rand'])
+        self.assertEqual(t.options['sorted_by'], [
+            {'Style': {'reverse': False}},
+            {'Number of Pages': {'reverse': True}},
+        ])
+
+    def test_multi_sort_option(self):
+        "A recorded multi-column sort can be passed back in"
+        t = TableFu(self.csv_file)
+        t.sort(['Style', 'Author'], reverse=True)
+        t2 = TableFu(self.table, sorted_by=t.options['sorted_by'])
+        self.assertEqual(t2.values('Author'), t.values('Author'))
+        self.assertEqual(t2.values('Author')[-2:], ['James Joyce', 'Nicholson Baker'])
+
+    def test_top(self):
+        "Pick the largest rows without sorting the table"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        top = t.top(2, by='Number of Pages')
+        self.assertEqual(top.values('Author'), ['Ayn Rand', 'James Joyce'])
+        self.assertEqual(top.options['sorted_by'], {'Number of Pages': {'reverse': True}})
+        self.assertEqual(t[0]['Author'], 'Samuel Beckett')
+        self.assertEqual(t.nsmallest(1, 'Number of Pages').values('Author'),
+            ['Samuel Beckett'])
+
+    def test_top_matches_sort(self):
+        "Top n is the start of the same sort"
+        t = TableFu(open('tests/arra.csv'), infer_types=True)
+        spec = [('State', False), ('ARRA Funds Obligated', True)]
+        top = t.top(20, by=spec, reverse=False)
+        t.sort(spec)
+        self.assertEqual([r.cells for r in top.rows], [r.cells for r in t[:20]])
+        self.assertEqual([r.cells for r in t.nlargest(3, 'Row').rows],
+            [r.cells for r in t.top(3, 'Row')])
+
+class TypesTest(TableTest):
+
+    def test_declared_type(self):
+        "Declared types are parsed once and cached"
+        t = TableFu(self.csv_file, types={'Number of Pages': 'int'})
+        self.assertEqual(t.column_type('Number of Pages'), int)
+        pages = t.typed_values('Number of Pages')
+        self.assertEqual(pages, [120, 644, 150, 263, 1088])
+        self.assertTrue(pages is t.typed_values('Number of Pages'))
+
+    def test_inferred_types(self):
+        "Types can be inferred for every column"
+        t = TableFu(self.csv_file, infer_types=True)
+        self.assertEqual(t.column_type('Number of Pages'), int)
+        self.assertEqual(t.column_type('Author'), None)
+
+    def test_zero_padded_codes(self):
+        "Codes with leading zeros stay strings, but decimals under one don't"
+        t = TableFu([['FIPS', 'Rate'], ['01001', '0.5'], ['06037', '1.25']],
+            infer_types=True, formatting={'FIPS': {'filter': 'capfirst'}})
+        self.assertEqual(t.column_type('FIPS'), None)
+        self.assertEqual(t.column_type('Rate'), float)
+        self.assertTrue('>01001<' in t.html())
+
+    def test_typed_sort(self):
+        "Typed columns sort as numbers"
+        t = TableFu(self.csv_file, infer_types=True)
+        t.sort('Number of Pages', reverse=True)
+        self.assertEqual(
+            t.values('Number of Pages'),
+            ['1088', '644', '263', '150', '120']
+        )
+        self.assertEqual(t.typed_values('Number of Pages'), [1088, 644, 263, 150, 120])
+
+    def test_typed_total(self):
+        "Totals skip blank cells in typed columns"
+        t = TableFu(self.table, types={'Number of Pages': float})
+        t.add_rows(['Anonymous', 'Beowulf', '', 'Epic'])
+        self.assertEqual(t.total('Number of Pages'), 2265.0)
+
+    def test_typed_filter(self):
+        "Non-string filter values match converted values"
+        t = TableFu(self.csv_file, types={'Number of Pages': 'int'})
+        f = t.filter(**{'Number of Pages': 644})
+        self.assertEqual(f.values('Author'), ['James Joyce'])
+
+    def test_typed_format(self):
+        "Formatters get converted values"
+        t = TableFu(self.table, types={'Number of Pages': 'decimal'})
+        t.formatting = {'Number of Pages': {'filter': 'dollars'}}
+        self.assertEqual(str(t[4]['Number of Pages']), '$1,088')
+
+    def test_bad_type(self):
+        "Unknown type names raise a ValueError"
+        self.assertRaises(ValueError, TableFu, self.table, types={'Author': 'person'})
+
+
 class ValuesTest(TableTest):
 
     def test_values(self):
@@ -249,6 +703,272 @@ class FacetTest(TableTest):
             tables[2][0].cells
         )
 
+class FacetViewTest(TableTest):
+
+    def test_facets_share_rows(self):
+        "Facets read rows from the parent table"
+        t = TableFu(self.csv_file, style={'Author': 'text-align:left;'})
+        modernism = t.facet_by('Style')[1]
+        self.assertEqual(modernism.faceted_on, 'Modernism')
+        self.assertTrue(modernism.table[0] is t.table[0])
+        self.assertEqual(list(modernism.table.positions), [0, 1])
+        self.assertTrue(modernism.style is t.style)
+        self.assertTrue(modernism.formatting is t.formatting)
+
+    def test_facet_api(self):
+        "Facets still act like tables"
+        t = TableFu(self.csv_file)
+        modernism = t.facet_by('Style')[1]
+        self.assertEqual(len(modernism), 2)
+        self.assertEqual(modernism.values('Author'), ['Samuel Beckett', 'James Joyce'])
+        self.assertEqual(modernism.total('Number of Pages'), 764.0)
+        self.assertEqual(modernism[1]['Author'], 'James Joyce')
+
+    def test_stale_facets(self):
+        "Facets of a table that's changed raise instead of reading moved rows"
+        t = TableFu(self.csv_file)
+        modernism, satire = t.facet_by('Style')[1:3]
+        satire.transform('Author', str.upper)
+        t.sort('Author')
+        self.assertRaises(ValueError, modernism.values, 'Style')
+        self.assertRaises(ValueError, lambda: modernism[0])
+        self.assertEqual(satire.values('Author'), ['VLADIMIR SOROKIN'])
+        self.assertEqual(t.facet_by('Style')[1].values('Style'), ['Modernism', 'Modernism'])
+
+        modernism = t.facet_by('Style')[1]
+        t.delete_row(0)
+        self.assertRaises(ValueError, modernism.values, 'Author')
+
+    def test_facet_types(self):
+        "Facets keep the parent's column types"
+        t = TableFu(self.csv_file, types={'Number of Pages': 'int'})
+        modernism = t.facet_by('Style')[1]
+        self.assertEqual(modernism.column_type('Number of Pages'), int)
+        self.assertEqual(modernism.values('Author'), ['Samuel Beckett', 'James Joyce'])
+        self.assertEqual(modernism.filter(**{'Number of Pages__gt': 200}).values('Author'),
+            ['James Joyce'])
+
+        t = TableFu(open('tests/test.csv'), infer_types=True)
+        t.column_type('Number of Pages')
+        self.assertEqual(t.facet_by('Style')[1].column_type('Number of Pages'), int)
+
+    def test_change_facet(self):
+        "Changing a facet leaves the parent alone"
+        t = TableFu(self.csv_file)
+        modernism = t.facet_by('Style')[1]
+        modernism.transform('Author', str.upper)
+        self.assertEqual(modernism.values('Author'), ['SAMUEL BECKETT', 'JAMES JOYCE'])
+        self.assertEqual(t[0]['Author'], 'Samuel Beckett')
+
+
+class GroupByTest(TableTest):
+
+    def test_aggregate(self):
+        "Aggregates come back as a new table, a row per group"
+        t = TableFu(self.csv_file)
+        g = t.group_by('Style').aggregate(
+            books=count,
+            pages=('Number of Pages', 'sum'),
+            longest=('Number of Pages', 'max'),
+        )
+        self.assertEqual(g.columns, ['Style', 'books', 'longest', 'pages'])
+        self.assertEqual(g.values('Style'),
+            ['Minimalism', 'Modernism', 'Satire', 'Science fiction'])
+        self.assertEqual(g[1].cells, ['Modernism', 2, 644.0, 764.0])
+
+    def test_typed_aggregates(self):
+        "Typed columns aggregate their typed values"
+        t = TableFu(self.csv_file, types={'Number of Pages': 'int'})
+        g = t.group_by('Style').aggregate(
+            pages=('Number of Pages', 'sum'),
+            average=Mean('Number of Pages'),
+            shortest=('Number of Pages', 'min'),
+        )
+        self.assertEqual(g[1].cells, ['Modernism', 382.0, 764, 120])
+
+    def test_text_aggregates(self):
+        "Min and max compare text as text"
+        t = TableFu(self.csv_file)
+        g = t.group_by('Style').aggregate(
+            first=('Author', 'min'),
+            last=('Author', 'max'),
+            shortest=('Number of Pages', 'min'),
+        )
+        self.assertEqual(g[1].cells, ['Modernism', 'James Joyce', 'Samuel Beckett', 120.0])
+
+    def test_custom_aggregates(self):
+        "Functions get a list of values, or of rows"
+        t = TableFu(self.csv_file)
+        g = t.group_by('Style').aggregate(
+            authors=('Author', ', '.join),
+            books=lambda rows: len(rows),
+        )
+        self.assertEqual(g[1].cells, ['Modernism', 'Samuel Beckett, James Joyce', 2])
+
+    def test_many_columns(self):
+        t = TableFu(open('tests/arra.csv'))
+        g = t.group_by('State', 'County').count()
+        self.assertEqual(g.columns, ['State', 'County', 'count'])
+        self.assertEqual(sum(g.values('count')), len(t))
+        colbert = g.filter(State='ALABAMA', County='COLBERT')
+        self.assertEqual(colbert[0]['count'], 5)
+
+    def test_lazy(self):
+        "Lazy tables are aggregated as they're read"
+        t = TableFu(self.csv_file, lazy=True)
+        g = t.group_by().aggregate(pages=('Number of Pages', 'sum'))
+        self.assertEqual(g[0]['pages'], 2265.0)
+
+    def test_bad_aggregate(self):
+        t = TableFu(self.csv_file)
+        self.assertRaises(ValueError, t.group_by('Style').aggregate,
+            x=('Author', 'median'))
+        self.assertRaises(ValueError, t.group_by('Style').aggregate,
+            x=('Author', 'sum'))
+        self.assertRaises(ValueError, t.group_by, 'Nope')
+
+
+class TrackTest(TableTest):
+
+    def test_track(self):
+        t = TableFu(self.csv_file)
+        totals = t.track('Number of Pages')
+        self.assertTrue(t.totals['Number of Pages'] is totals)
+        self.assertEqual(totals['sum'], 2265.0)
+        self.assertEqual(totals['count'], 5)
+        self.assertEqual(totals['min'], 120.0)
+        self.assertEqual(totals['max'], 1088.0)
+        self.assertEqual(totals['mean'], 453.0)
+        self.assertEqual(t.total('Number of Pages'), 2265.0)
+
+    def test_changes(self):
+        "Totals follow added, updated and deleted rows"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        totals = t.track('Number of Pages', ['sum', 'max', 'min'])
+        t.add_rows(['Jack Kerouac', 'On the Road', '320', 'Beat'], ['Nobody', '', '', ''])
+        self.assertEqual((totals['sum'], totals['max']), (2585, 1088))
+        t.update_row(4, {'Number of Pages': '2000'})
+        self.assertEqual((totals['sum'], totals['max']), (3497, 2000))
+        self.assertEqual(t.typed_values('Number of Pages')[4], 2000)
+        t.delete_row(4)
+        self.assertEqual((totals['sum'], totals['max']), (1497, 644))
+        t.delete_row(0)
+        self.assertEqual(totals['min'], 150)
+        self.assertEqual(t.total('Number of Pages'), float(sum(
+            int(v) for v in t.values('Number of Pages') if v)))
+        self.assertRaises(KeyError, lambda: totals['mean'])
+
+    def test_transform(self):
+        t = TableFu(self.csv_file)
+        totals = t.track('Number of Pages')
+        t.transform('Number of Pages', lambda v: int(v) * 2)
+        self.assertEqual(totals['sum'], 4530)
+
+    def test_bad_values(self):
+        "Rows that can't be totaled aren't added"
+        t = TableFu(self.csv_file)
+        t.track('Number of Pages')
+        self.assertRaises(ValueError, t.add_rows, ['A', 'B', 'many', 'C'])
+        self.assertEqual(len(t), 5)
+        self.assertRaises(ValueError, t.track, 'Author')
+        self.assertRaises(ValueError, t.track, 'Number of Pages', ['median'])
+        self.assertFalse('Author' in t.totals)
+        t.add_rows(['A', 'B', '100', 'C'])
+        t.delete_row(0)
+        self.assertEqual(t.totals['Number of Pages']['sum'], 2245.0)
+
+    def test_retyped_column(self):
+        "Rows that change an inferred type are tracked with the new type"
+        t = TableFu(self.csv_file, infer_types=True)
+        totals = t.track('Number of Pages')
+        self.assertEqual(totals.func, int)
+        t.add_rows(['A', 'B', '1.5', 'C'])
+        self.assertEqual(t.column_type('Number of Pages'), float)
+        self.assertEqual(totals.func, float)
+        self.assertEqual(totals['sum'], 2266.5)
+        self.assertRaises(ValueError, t.add_rows, ['A', 'B', 'many', 'C'])
+        self.assertEqual(len(t), 6)
+
+    def test_blank_totals(self):
+        "Blank cells are left out of totals, tracked or not"
+        rows = [['n'], ['1'], [''], ['2']]
+        t = TableFu([list(r) for r in rows])
+        self.assertEqual(t.total('n'), 3.0)
+        t.track('n')
+        self.assertEqual(t.total('n'), 3.0)
+
+    def test_columnar_update(self):
+        t = TableFu(self.csv_file, columnar=True)
+        t.track('Number of Pages')
+        t.update_row(0, {'Number of Pages': 130, 'Author': 'Beckett'})
+        self.assertEqual(t.values('Number of Pages')[0], 130)
+        self.assertEqual(t[0]['Author'].value, 'Beckett')
+        self.assertEqual(t.totals['Number of Pages']['sum'], 2275)
+
+
+class JoinTest(TableTest):
+
+    def setUp(self):
+        super(JoinTest, self).setUp()
+        self.styles = [
+            ['Style', 'Movement', 'Author'],
+            ['Modernism', 'Early 20th century', 'Various'],
+            ['Satire', 'Ancient', 'Various'],
+            ['Modernism', 'Literary', 'Various'],
+            ['Romance', '18th century', 'Various'],
+        ]
+
+    def test_inner_join(self):
+        "Rows with a match in both tables, in this table's order"
+        t = TableFu(self.csv_file)
+        j = t.join(TableFu(self.styles), on='Style')
+        self.assertEqual(j.default_columns, ['Author', 'Best Book',
+            'Number of Pages', 'Style', 'Movement', 'Author_2'])
+        self.assertEqual(j.values('Author'), ['Samuel Beckett', 'Samuel Beckett',
+            'James Joyce', 'James Joyce', 'Vladimir Sorokin'])
+        self.assertEqual(j.values('Movement')[:2], ['Early 20th century', 'Literary'])
+
+    def test_left_join(self):
+        "Every row in this table, with blanks where nothing matches"
+        t = TableFu(self.csv_file)
+        j = t.join(TableFu(self.styles), on='Style', how='left')
+        self.assertEqual(len(j), 7)
+        self.assertEqual(j[4].cells, self.table[3] + ['', ''])
+        self.assertEqual(j[6].cells, self.table[5] + ['', ''])
+
+    def test_build_either_side(self):
+        "The result is the same whichever side is hashed"
+        big = TableFu(open('tests/arra.csv'))
+        small = TableFu([['State', 'Region'], ['ALABAMA', 'South'], ['ALASKA', 'West']])
+        j1 = small.join(big, on='State')
+        j2 = big.join(small, on='State').filter(State__in=['ALABAMA', 'ALASKA'])
+        self.assertEqual(len(j1), len(j2))
+        self.assertEqual(j1.values('Region')[0], 'South')
+        self.assertEqual(set(j1.values('Row')), set(j2.values('Row')))
+
+    def test_join_carries_options(self):
+        t = TableFu(self.csv_file, formatting={'Number of Pages': {'filter': 'intcomma'}})
+        styles = TableFu(self.styles, formatting={'Movement': {'filter': 'title'}})
+        j = t.join(styles, on='Style', how='left')
+        self.assertEqual(j.formatting, {
+            'Number of Pages': {'filter': 'intcomma'},
+            'Movement': {'filter': 'title'},
+        })
+        self.assertEqual(str(j[0]['Movement']), 'Early 20th Century')
+
+    def test_multi_column_join(self):
+        t = TableFu(self.csv_file)
+        other = TableFu([['Author', 'Style', 'Born'], ['James Joyce', 'Modernism', '1882'],
+            ['James Joyce', 'Satire', '1882']])
+        j = t.join(other, on=['Author', 'Style'])
+        self.assertEqual(j.values('Born'), ['1882'])
+
+    def test_bad_join(self):
+        t = TableFu(self.csv_file)
+        self.assertRaises(ValueError, t.join, TableFu(self.styles), 'Style', 'outer')
+        self.assertRaises(ValueError, t.join, TableFu(self.styles), 'Movement')
+
+
 class FilterTest(TableTest):
     
     def test_count(self):
@@ -282,6 +1002,265 @@ class FilterTest(TableTest):
         self.assertEqual(f.count(), 5)
 
 
+class QueryTest(TableTest):
+
+    def test_numeric_operators(self):
+        "Compare numbers with gt, lte and range"
+        t = TableFu(self.csv_file)
+        self.assertEqual(
+            t.filter(**{'Number of Pages__gt': 300}).values('Author'),
+            ['James Joyce', 'Ayn Rand']
+        )
+        self.assertEqual(
+            t.filter(**{'Number of Pages__lte': 150}).values('Author'),
+            ['Samuel Beckett', 'Nicholson Baker']
+        )
+        self.assertEqual(
+            t.filter(**{'Number of Pages__range': (150, 644)}).count(),
+            3
+        )
+
+    def test_in(self):
+        "Match any of several values"
+        t = TableFu(self.csv_file)
+        f = t.filter(Style__in=['Satire', 'Minimalism'])
+        self.assertEqual(f.values('Author'), ['Nicholson Baker', 'Vladimir Sorokin'])
+
+    def test_string_operators(self):
+        "Match parts of strings"
+        t = TableFu(self.csv_file)
+        self.assertEqual(t.filter(Author__startswith='S').count(), 1)
+        self.assertEqual(t.filter(Author__endswith='Rand').count(), 1)
+        self.assertEqual(t.filter(Style__icontains='ISM').count(), 3)
+        self.assertEqual(t.filter(Style__iexact='satire').count(), 1)
+
+    def test_isnull(self):
+        "Match blank cells"
+        t = TableFu(self.table)
+        t.add_rows(['Anonymous', 'Beowulf', '', 'Epic'])
+        f = t.filter(**{'Number of Pages__isnull': True})
+        self.assertEqual(f.values('Author'), ['Anonymous'])
+        self.assertEqual(t.filter(**{'Number of Pages__isnull': False}).count(), 5)
+
+    def test_combined(self):
+        "Several operators are checked in one pass"
+        t = TableFu(self.csv_file)
+        f = t.filter(Style='Modernism', **{'Number of Pages__gt': 200})
+        self.assertEqual(f.values('Author'), ['James Joyce'])
+
+    def test_typed_comparison(self):
+        "Typed columns compare their parsed values"
+        t = TableFu(self.csv_file, infer_types=True)
+        f = t.filter(**{'Number of Pages__gte': 644})
+        self.assertEqual(f.values('Author'), ['James Joyce', 'Ayn Rand'])
+
+    def test_bad_lookup(self):
+        "Unknown columns raise a KeyError"
+        t = TableFu(self.csv_file)
+        self.assertRaises(KeyError, t.filter, Publisher='Grove')
+        self.assertRaises(KeyError, t.filter, Author__like='S')
+
+
+class PlanTest(TableTest):
+
+    def test_plan_is_lazy(self):
+        "Nothing is read until a query is used"
+        f = open('tests/arra.csv')
+        t = TableFu(f, lazy=True)
+        q = t.query().where(State='ALABAMA').select('County').limit(3)
+        self.assertTrue(t.lazy)
+        self.assertEqual(q.values('County'), ['MADISON', 'HOUSTON', 'HOUSTON'])
+        self.assertEqual(q.columns, ['County'])
+        # limit stopped reading the file early
+        self.assertTrue(f.tell() < os.path.getsize('tests/arra.csv'))
+        self.assertFalse(t.lazy)
+
+    def test_merge_steps(self):
+        "Adjacent steps are merged"
+        t = TableFu(self.csv_file)
+        q = t.query().where(Style='Modernism').where(Author__startswith='J')
+        q = q.order_by('Author').order_by('Style').limit(3).limit(2)
+        self.assertEqual(len(q.steps), 3)
+        self.assertEqual(q.plan(), [(
+            [{'Style': 'Modernism'}, {'Author__startswith': 'J'}],
+            [('Style', False), ('Author', False)],
+            2,
+        )])
+        self.assertEqual(q.values('Author'), ['James Joyce'])
+
+    def test_matches_eager(self):
+        "A query gets the same rows as filter, sort and slicing"
+        t = TableFu(open('tests/arra.csv'), infer_types=True)
+        q = t.query().where(State__in=['ALABAMA', 'TEXAS'])
+        q = q.order_by(('ARRA Funds Obligated', True), 'Row').limit(10)
+        eager = t.filter(State__in=['ALABAMA', 'TEXAS'])
+        eager.sort([('ARRA Funds Obligated', True), 'Row'])
+        self.assertEqual([r.cells for r in q], [r.cells for r in eager[:10]])
+        self.assertEqual(q.result.options['sorted_by'], [
+            {'ARRA Funds Obligated': {'reverse': True}},
+            {'Row': {'reverse': False}},
+        ])
+
+    def test_limit_then_filter(self):
+        "Steps after a limit work on the limited rows"
+        t = TableFu(self.csv_file)
+        q = t.query().limit(3).where(Style='Modernism').select('Author')
+        self.assertEqual(q.values('Author'), ['Samuel Beckett', 'James Joyce'])
+        self.assertEqual(q.result.columns, ['Author'])
+
+    def test_indexed_query(self):
+        "Queries use indexes, as filter does"
+        t = TableFu(self.csv_file)
+        t.create_index('Style')
+        q = t.query().where(Style='Satire', Author__contains='Sorokin')
+        self.assertEqual(q.values('Author'), ['Vladimir Sorokin'])
+
+    def test_bad_columns(self):
+        t = TableFu(self.csv_file)
+        self.assertRaises(ValueError, t.query().select, 'Nope')
+        self.assertRaises(ValueError, t.query().order_by, 'Nope')
+        self.assertRaises(KeyError, t.query().select('Author').where, Style='Satire')
+
+
+class IndexTest(TableTest):
+
+    def test_create_index(self):
+        "An index maps values to row positions"
+        t = TableFu(self.csv_file)
+        index = t.create_index('Style')
+        self.assertEqual(list(index.lookup('Modernism')), [0, 1])
+        self.assertEqual(len(index), 4)
+
+    def test_indexed_filter(self):
+        "Filters on indexed columns match unindexed ones"
+        t = TableFu(self.csv_file)
+        expected = t.filter(Style='Modernism', **{'Number of Pages__gt': 200}).table
+        t.create_index('Style')
+        self.assertEqual(
+            t.filter(Style='Modernism', **{'Number of Pages__gt': 200}).table,
+            expected
+        )
+        self.assertEqual(
+            t.filter(Style__in=['Satire', 'Modernism']).values('Author'),
+            ['Samuel Beckett', 'James Joyce', 'Vladimir Sorokin']
+        )
+        self.assertEqual(t.filter(Style='Romance').count(), 0)
+
+    def test_indexed_values_and_facets(self):
+        "Unique values and facets come from the index"
+        t = TableFu(self.csv_file)
+        facets = [(f.faceted_on, f.table) for f in t.facet_by('Style')]
+        t.create_index('Style')
+        self.assertEqual(t.values('Style', unique=True), set(t.values('Style')))
+        self.assertEqual([(f.faceted_on, f.table) for f in t.facet_by('Style')], facets)
+
+    def test_index_maintenance(self):
+        "Indexes follow add_rows, sort, transform and delete_row"
+        t = TableFu(self.csv_file)
+        t.create_index('Style')
+        t.add_rows(['Jack Kerouac', 'On the Road', '320', 'Beat'])
+        self.assertEqual(t.filter(Style='Beat').values('Author'), ['Jack Kerouac'])
+        t.sort('Author')
+        self.assertEqual(t.filter(Style='Modernism').values('Author'),
+            ['James Joyce', 'Samuel Beckett'])
+        t.transform('Style', str.upper)
+        self.assertEqual(t.filter(Style='MODERNISM').count(), 2)
+        self.assertEqual(t.filter(Style='Modernism').count(), 0)
+        t.delete_row(0)
+        self.assertEqual(t.filter(Style='MODERNISM').values('Author'), ['James Joyce', 'Samuel Beckett'])
+        self.assertEqual(t.filter(Style='BEAT').values('Author'), ['Jack Kerouac'])
+
+
+class SortedIndexTest(TableTest):
+
+    def test_sorted_index(self):
+        "A sorted index keeps typed values in order"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        index = t.create_index('Number of Pages', kind='sorted')
+        self.assertEqual(index.keys, [120, 150, 263, 644, 1088])
+        self.assertEqual(list(index.positions), [0, 2, 3, 1, 4])
+
+    def test_range_filters(self):
+        "Range filters on a sorted index match a full scan"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        queries = [
+            {'Number of Pages__range': (100, 300)},
+            {'Number of Pages__gt': 263},
+            {'Number of Pages__gte': 263},
+            {'Number of Pages__lt': 150},
+            {'Number of Pages__lte': 150},
+            {'Number of Pages': 644},
+        ]
+        expected = [t.filter(**q).table for q in queries]
+        t.create_index('Number of Pages', kind='sorted')
+        self.assertEqual([t.filter(**q).table for q in queries], expected)
+
+    def test_min_max(self):
+        "Min and max come from the ends of the index"
+        t = TableFu(self.csv_file, infer_types=True)
+        self.assertEqual(t.min('Number of Pages'), 120)
+        t.create_index('Number of Pages', kind='sorted')
+        self.assertEqual(t.min('Number of Pages'), 120)
+        self.assertEqual(t.max('Number of Pages'), 1088)
+        self.assertEqual(t.max('Author'), 'Vladimir Sorokin')
+
+    def test_min_max_untyped(self):
+        "Untyped columns are read as numbers, not compared as strings"
+        t = TableFu(self.csv_file)
+        self.assertEqual(t.max('Number of Pages'), 1088.0)
+        self.assertEqual(t.min('Number of Pages'), 120.0)
+        t.create_index('Number of Pages', kind='sorted')
+        self.assertEqual(t.max('Number of Pages'), 1088.0)
+        self.assertEqual(t.max('Number of Pages'), t.track('Number of Pages')['max'])
+        # text is compared as text
+        self.assertEqual(t.min('Author'), 'Ayn Rand')
+        t.create_index('Author', kind='sorted')
+        self.assertEqual(t.max('Author'), 'Vladimir Sorokin')
+
+    def test_numeric_index(self):
+        "Untyped columns of numbers are indexed as numbers"
+        t = TableFu(self.csv_file)
+        long_books = t.filter(**{'Number of Pages__gt': 200}).table
+        index = t.create_index('Number of Pages', kind='sorted')
+        self.assertTrue(index.numeric)
+        self.assertEqual(index.keys, [120.0, 150.0, 263.0, 644.0, 1088.0])
+        self.assertEqual(t.min('Number of Pages'), 120.0)
+        # number filters can use it
+        positions = t._indexed_positions(compile_query(t, {'Number of Pages__gt': 200}))
+        self.assertEqual(list(positions), [1, 3, 4])
+        self.assertEqual(t.filter(**{'Number of Pages__gt': 200}).table, long_books)
+        t.add_rows(['Jack Kerouac', 'On the Road', '99', 'Beat'])
+        self.assertEqual(t.min('Number of Pages'), 99.0)
+        t.add_rows(['Anon', 'Untitled', 'lots', 'Beat'])
+        self.assertFalse(index.numeric)
+        self.assertEqual(t.max('Number of Pages'), 'lots')
+
+    def test_ordered_by(self):
+        "Iterate in column order without sorting the table"
+        t = TableFu(self.csv_file, infer_types=True)
+        t.create_index('Number of Pages', kind='sorted')
+        authors = [row['Author'].value for row in t.ordered_by('Number of Pages', reverse=True)]
+        self.assertEqual(authors[0], 'Ayn Rand')
+        self.assertEqual(t[0]['Author'], 'Samuel Beckett')
+
+    def test_presorted(self):
+        "A table sorted on the column reuses its order"
+        t = TableFu(self.csv_file, infer_types=True, sorted_by={'Number of Pages': {'reverse': True}})
+        index = t.create_index('Number of Pages', kind='sorted')
+        self.assertEqual(list(index.positions), [4, 3, 2, 1, 0])
+        self.assertEqual(index.keys, [120, 150, 263, 644, 1088])
+
+    def test_sorted_index_maintenance(self):
+        "Sorted indexes follow new rows"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        t.create_index('Number of Pages', kind='sorted')
+        t.add_rows(['Jack Kerouac', 'On the Road', '320', 'Beat'])
+        self.assertEqual(
+            t.filter(**{'Number of Pages__range': (300, 400)}).values('Author'),
+            ['Jack Kerouac']
+        )
+
+
 class OptionsTest(TableTest):
     
     def test_sort_option_str(self):
@@ -319,6 +1298,54 @@ class DatumFormatTest(TableTest):
             '<a href="http://www.chrisamico.com" title="ChrisAmico.com">ChrisAmico.com</a>'
         )
 
+    def test_compiled_formatting(self):
+        "Formatting is compiled once, until it changes"
+        t = TableFu(self.csv_file, formatting={'Name': {'filter': 'link', 'args': ['URL']}})
+        plan = t._render_plan()
+        html = t.html()
+        self.assertTrue(t._render_plan() is plan)
+        self.assertTrue('title="ChrisAmico.com"' in html)
+
+        t.formatting['About'] = {'filter': 'capfirst'}
+        self.assertFalse(t._render_plan() is plan)
+        self.assertEqual(str(t[1]['About']), 'Builders of the ruby version of this library')
+
+        plan = t._render_plan()
+        t.columns = ['Name', 'About']
+        self.assertFalse(t._render_plan() is plan)
+
+    def test_nested_formatting(self):
+        "Changing a column's formatting in place is seen"
+        spec = {'filter': 'capfirst'}
+        t = TableFu(self.csv_file, formatting={'About': spec})
+        self.assertEqual(str(t[1]['About']), 'Builders of the ruby version of this library')
+        t.formatting['About']['filter'] = 'title'
+        self.assertEqual(str(t[1]['About']), 'Builders Of The Ruby Version Of This Library')
+        del t.formatting['About']['filter']
+        self.assertEqual(str(t[1]['About']), 'Builders of the Ruby version of this library')
+        t.formatting.setdefault('Name', {})['filter'] = 'title'
+        self.assertEqual(str(t[1]['Name']), 'Propublica')
+        # the dict passed in is copied, not changed
+        self.assertEqual(spec, {'filter': 'capfirst'})
+
+    def test_formatting_carries_over(self):
+        "Changes to formatting reach tables made from this one"
+        t = TableFu(self.csv_file, formatting={'Name': {'filter': 'link', 'args': ['URL']}})
+        t.formatting['About'] = {'filter': 'capfirst'}
+        self.assertTrue(t.options['formatting'] is t.formatting)
+        for other in (t.filter(Name='ProPublica'), t.transpose(), t.query().execute()):
+            self.assertTrue('About' in other.formatting)
+        self.assertEqual(str(t.filter(Name='ProPublica')[0]['About']),
+            'Builders of the ruby version of this library')
+
+    def test_row_cells(self):
+        "Arguments come from the row being formatted"
+        t = TableFu(self.csv_file, formatting={'Name': {'filter': 'link', 'args': ['URL']}})
+        row = t[0]
+        row['URL'] = 'http://example.com'
+        self.assertTrue('href="http://example.com"' in str(row['Name']))
+        self.assertTrue('href="http://example.com"' in row.as_tr())
+
 class HTMLTest(TableTest):
     
     def test_datum_td(self):
@@ -344,6 +1371,35 @@ class HTMLTest(TableTest):
         hed = t.headers[0]
         self.assertEqual(hed.as_th(), '<th style="" class="header">Author</th>')
 
+    def test_iter_html(self):
+        "HTML comes in chunks of rows, which add up to html()"
+        t = TableFu(self.csv_file, style={'Author': 'text-align:left;'})
+        chunks = list(t.iter_html(chunk_rows=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(''.join(chunks), t.html())
+        self.assertEqual(''.join(t.iter_html(chunk_rows=10)), t.html())
+        self.assertTrue('<th style="text-align:left;" class="header">Author</th>' in chunks[0])
+        self.assertTrue(t.html().endswith('Science fiction</td></tr>\n</tbody>\n</table>'))
+
+    def test_html_non_ascii_header(self):
+        "Byte string headers aren't encoded again"
+        t = TableFu([['Caf\xc3\xa9', 'Name'], ['1', 'x']])
+        self.assertEqual(str(t.headers[0]), 'Caf\xc3\xa9')
+        self.assertTrue('<th style="" class="header">Caf\xc3\xa9</th>' in t.html())
+        t = TableFu([[u'Caf\xe9'], [u'1']])
+        self.assertEqual(t.headers[0].as_th(), '<th style="" class="header">Caf\xc3\xa9</th>')
+
+    def test_write_html(self):
+        "Stream a lazy table's HTML to a file"
+        from StringIO import StringIO
+        out = StringIO()
+        t = TableFu(self.csv_file, lazy=True, formatting={'Number of Pages': {'filter': 'dollars'}})
+        t.write_html(out, chunk_rows=1)
+        html = out.getvalue()
+        self.assertTrue(isinstance(html, str))
+        self.assertTrue('<td style="" class="datum">$1,088</td>' in html)
+        self.assertEqual(html.count('<tr id='), 5)
+
 
 class StyleTest(TableTest):
     
@@ -388,6 +1444,64 @@ class OutputTest(TableTest):
         for test, control in zip(t.csv(), self.csv_file.readline()):
             self.assertEqual(test.strip(), control.strip()) # controlling for newlines
     
+    def test_write_csv(self):
+        "Write raw cells for the shown columns"
+        from StringIO import StringIO
+        t = TableFu(self.csv_file)
+        self.csv_file.seek(0)
+        out = StringIO()
+        t.write_csv(out, chunk_rows=3)
+        self.assertEqual(list(csv.reader(StringIO(out.getvalue()))),
+            list(csv.reader(self.csv_file)))
+        self.assertEqual(out.getvalue(), t.csv().getvalue())
+
+        t.columns = ['State', 'ARRA Funds Obligated']
+        out = StringIO()
+        t.write_csv(out)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows[0], t.columns)
+        self.assertEqual(rows[1], [t[0]['State'].value, t[0]['ARRA Funds Obligated'].value])
+        self.assertEqual(len(rows), t.count() + 1)
+
+    def test_write_csv_formatted(self):
+        "Write cells as they're formatted for HTML"
+        from StringIO import StringIO
+        t = TableFu(self.csv_file, lazy=True,
+            formatting={'ARRA Funds Obligated': {'filter': 'dollars'}})
+        t.columns = ['State', 'ARRA Funds Obligated']
+        out = StringIO()
+        t.write_csv(out, formatted=True)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows[0], ['State', 'ARRA Funds Obligated'])
+        self.assertTrue(all(row[1].startswith('$') for row in rows[1:]))
+
+    def test_query_write_csv(self):
+        "Stream a query's rows without building a table"
+        from StringIO import StringIO
+        t = TableFu(self.csv_file)
+        q = t.query().where(State='ALABAMA').select('State', 'ARRA Funds Obligated')
+        out = StringIO()
+        q.write_csv(out)
+        self.assertTrue(q._result is None)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(out.getvalue(), q.csv().getvalue())
+        self.assertEqual(len(rows), q.count() + 1)
+        self.assertTrue(all(row[0] == 'ALABAMA' for row in rows[1:]))
+
+    def test_query_write_csv_columns(self):
+        "Streamed and built results show the same columns"
+        from StringIO import StringIO
+        t = TableFu(self.csv_file)
+        t.columns = ['County', 'State']
+        q = t.query().where(State='ALABAMA').limit(3)
+        streamed = StringIO()
+        q.write_csv(streamed)
+        self.assertTrue(q._result is None)
+        built = StringIO()
+        q.execute().write_csv(built)
+        self.assertEqual(streamed.getvalue(), built.getvalue())
+        self.assertEqual(streamed.getvalue().splitlines()[:2], ['County,State', 'MADISON,ALABAMA'])
+
     def test_json(self):
         try:
             import json
@@ -467,6 +1581,59 @@ class FormatTest(unittest.TestCase):
         self.format = Formatter()
 
 
+class CacheFilterTest(unittest.TestCase):
+
+    def test_cached_filter(self):
+        "Cached filters count hits and misses"
+        format = Formatter()
+        format.register('intcomma', cache=True, func=format._filters['intcomma'])
+        for value in [1200, 1200, 3000, 1200]:
+            format(value, 'intcomma')
+        info = format.cache_info('intcomma')
+        self.assertEqual((info['hits'], info['misses'], info['size']), (2, 2, 2))
+        self.assertEqual(format(1200.0, 'intcomma'), '1,200.0')
+        self.assertRaises(ValueError, format.cache_info, 'dollars')
+
+    def test_eviction(self):
+        "The least recently used result goes first"
+        calls = []
+        def shout(value):
+            calls.append(value)
+            return value.upper()
+        format = Formatter(cache=True, cache_size=2)
+        format.register(shout)
+        for value in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self.assertEqual(format(value, 'shout'), value.upper())
+        self.assertEqual(calls, ['a', 'b', 'c', 'b'])
+        self.assertEqual(format.cache_info('shout')['evictions'], 2)
+
+    def test_arguments(self):
+        format = Formatter(cache=True)
+        self.assertEqual(format('A', 'link', 'http://a.com'), format('A', 'link', 'http://a.com'))
+        self.assertTrue('b.com' in format('A', 'link', 'http://b.com'))
+        self.assertEqual(format.cache_info('link')['misses'], 2)
+        # unhashable values are passed straight through
+        self.assertEqual(format(['a'], 'capfirst', failure_string='x'), 'x')
+
+    def test_set_cache(self):
+        format = Formatter()
+        format.set_cache(True, 10)
+        self.assertEqual(format.cache_info('ap_state')['maxsize'], 10)
+        format.set_cache(False)
+        self.assertEqual(format.cache_info(), {})
+        self.assertFalse(hasattr(format._filters['ap_state'], 'info'))
+
+    def test_set_cache_keeps_caches(self):
+        "Caching every filter leaves filters that are already cached alone"
+        format = Formatter()
+        format.register(capfirst, cache=True, cache_size=100)
+        format('texas', 'capfirst')
+        format.set_cache(True)
+        info = format.cache_info('capfirst')
+        self.assertEqual((info['maxsize'], info['misses']), (100, 1))
+        self.assertEqual(format.cache_info('ap_state')['maxsize'], format.cache_size)
+
+
 class RegisterTest(FormatTest):
 
     def test_register(self):
@@ -485,6 +1652,25 @@ class RegisterTest(FormatTest):
             self.format(1200, 'intcomma'),
             '1,200'
         )
+
+    def test_intcomma_values(self):
+        "intcomma groups the leading digits of anything"
+        for value, result in [
+            (-1234567, '-1,234,567'), (999, '999'), (10 ** 20, '100,000,000,000,000,000,000'),
+            (1234567.5, '1,234,567.5'), ('12345abc', '12,345abc'), ('abc', 'abc'),
+        ]:
+            self.assertEqual(self.format(value, 'intcomma'), result)
+
+    def test_many(self):
+        "Format a whole column at once"
+        self.assertEqual(
+            self.format.many([1200, 3, 45000], 'dollars'),
+            [u'$1,200', u'$3', u'$45,000']
+        )
+        self.assertEqual(
+            self.format.many([0.5, 'x'], 'percentage', 2, failure_string='-'),
+            ['50.00%', '-']
+        )
     
     def test_ap_state(self):
         "Return AP state style of a state"
@@ -706,6 +1892,66 @@ class OpenerTest(unittest.TestCase):
         t2 = TableFu(urllib2.urlopen(url))
         self.assertEqual(t1.table, t2.table)
 
+class LocalServerTest(unittest.TestCase):
+    """
+    Load tables from a local HTTP server, counting
+    the connections it sees
+    """
+    def setUp(self):
+        import threading
+        import BaseHTTPServer, SimpleHTTPServer, SocketServer
+        connections = self.connections = []
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                connections.append(self.client_address)
+                SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.base = 'http://127.0.0.1:%s/tests/' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_from_urls(self):
+        "Load several tables at once, in order"
+        names = ['test.csv', 'sites.csv', 'arra.csv']
+        tables = TableFu.from_urls([self.base + n for n in names])
+        for name, t in zip(names, tables):
+            self.assertEqual(t.table, TableFu.from_file('tests/' + name).table)
+
+    def test_connection_reuse(self):
+        "Requests to the same host share connections"
+        urls = [self.base + 'test.csv'] * 10
+        tables = TableFu.from_urls(urls, concurrency=2)
+        self.assertEqual(len(tables), 10)
+        self.assertTrue(len(self.connections) <= 2)
+
+    def test_from_urls_lazy(self):
+        "Tables sharing a connection are read in full"
+        names = ['arra.csv', 'arra.csv']
+        tables = TableFu.from_urls([self.base + n for n in names], concurrency=1, lazy=True)
+        for t in tables:
+            self.assertFalse(t.lazy)
+            self.assertEqual(t.table, TableFu.from_file('tests/arra.csv').table)
+
+    def test_missing_url(self):
+        "Errors are raised in the calling thread"
+        self.assertRaises(IOError, TableFu.from_urls, [self.base + 'missing.csv'])
+
+
 class RemoteTest(unittest.TestCase):
     
     def test_use_url(self):
@@ -732,7 +1978,64 @@ class UpdateTest(TableTest):
         t.transform('Number of Pages', int)
         for s, i in zip(pages, t.values('Number of Pages')):
             self.assertEqual(int(s), i)
+
+    def test_batch_transform(self):
+        "Batch transforms get the whole column"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        calls = []
+        def double(pages):
+            calls.append(pages)
+            return [p * 2 for p in pages]
+        t.transform('Number of Pages', double, batch=True)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(t.values('Number of Pages'), [240, 1288, 300, 526, 2176])
+        self.assertRaises(ValueError, t.transform, 'Author', lambda v: v[:2], batch=True)
+
+    def test_batch_numpy(self):
+        "Batch functions get lists unless they ask for NumPy arrays"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        double = lambda pages: pages * 2
+        # a list doubles in length, so there's a value too many per row
+        self.assertRaises(ValueError, t.transform, 'Number of Pages', double, batch=True)
+        if has_numpy:
+            t.transform('Number of Pages', double, batch=True, numpy=True)
+            self.assertEqual(t.values('Number of Pages')[:2], [480, 2576])
+        else:
+            self.assertRaises(ValueError, t.transform, 'Number of Pages', double,
+                batch=True, numpy=True)
+            self.assertRaises(ValueError, t.derive, 'Double', double,
+                'Number of Pages', batch=True, numpy=True)
+
+    def test_derive(self):
+        "Make a new column from others"
+        t = TableFu(self.csv_file, types={'Number of Pages': int})
+        t.derive('Pages per letter', lambda pages, author: pages / len(author),
+            'Number of Pages', 'Author')
+        self.assertEqual(t.default_columns[-1], 'Pages per letter')
+        self.assertEqual(t[0]['Pages per letter'].value, 8)
+        t.derive('Pages per letter', lambda pages: [0] * len(pages),
+            'Number of Pages', batch=True)
+        self.assertEqual(t.values('Pages per letter'), [0] * 5)
+        self.assertEqual(len(t.default_columns), 5)
+
+    def test_derive_columnar(self):
+        t = TableFu(self.csv_file, columnar=True, columns=['Author'])
+        t.derive('Long', lambda pages: pages > 500, 'Number of Pages')
+        self.assertEqual(t.values('Long'), [False, True, False, False, True])
+        self.assertEqual(t.columns, ['Author', 'Long'])
         
+    def test_update_sorted_columnar(self):
+        "Updating a sorted columnar table updates its parsed columns"
+        t = TableFu([['k', 'n'], ['b', '1'], ['c', '2'], ['a', '3']], columnar=True)
+        t.typed_values('n')
+        t.sort('k')
+        self.assertEqual(list(t.typed_values('n')), [3, 1, 2])
+        t.update_row(0, {'n': '100'})
+        self.assertEqual(t.total('n'), 103)
+        self.assertEqual(t.max('n'), 100)
+        t.create_index('n', kind='sorted')
+        self.assertEqual(t.filter(n__gt=50).values('k'), ['a'])
+
 
 
 if __name__ == '__main__':